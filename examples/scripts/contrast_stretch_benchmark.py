@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+
+import sys
+import time
+
+import numpy as np
+from skimage import exposure
+
+import hsfm
+
+"""
+Compares the histogram/lookup table contrast kernels in hsfm.image with the
+np.percentile and exposure.rescale_intensity implementation they replace.
+
+Usage: python contrast_stretch_benchmark.py [scan.tif]
+Without an input file a synthetic full size scan is used.
+"""
+
+if len(sys.argv) > 1:
+    img_gray = hsfm.io.read_image_windows(sys.argv[1], [[0, 10**9, 0, 10**9]])[0]
+else:
+    # roughly the size of a scanned 9x9 inch frame
+    # built in row blocks to avoid a full size float64 temporary
+    rng = np.random.default_rng(0)
+    img_gray = np.empty((22000, 22000), dtype=np.uint8)
+    for row in range(0, img_gray.shape[0], 1000):
+        block = img_gray[row:row+1000]
+        block[:] = rng.normal(120, 40, size=block.shape).clip(0, 255)
+
+print('Image shape:', img_gray.shape)
+
+def timed(label, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    print(label, round(time.time() - start, 2), 's')
+    return result
+
+def img_linear_stretch_percentile(img_gray, min_max=(0.1, 99.9)):
+    p_min, p_max = np.percentile(img_gray, min_max)
+    return exposure.rescale_intensity(img_gray, in_range=(p_min, p_max))
+
+print('img_linear_stretch')
+reference = timed('  np.percentile + rescale_intensity:', img_linear_stretch_percentile, img_gray)
+result    = timed('  histogram + lookup table:         ', hsfm.image.img_linear_stretch, img_gray)
+print('  identical:', np.array_equal(reference, result))
+
+print('img_linear_stretch_full')
+reference = timed('  np.percentile + rescale_intensity:', img_linear_stretch_percentile, img_gray, (20, 80))
+result    = timed('  histogram + lookup table:         ', hsfm.image.img_linear_stretch_full, img_gray)
+print('  identical:', np.array_equal(reference, result))
+
+del reference, result
+
+print('CLAHE and stretch')
+clahe     = timed('  clahe_equalize_image:             ', hsfm.image.clahe_equalize_image, img_gray)
+reference = timed('  np.percentile + rescale_intensity:', img_linear_stretch_percentile, clahe)
+result    = timed('  clahe_equalize_and_stretch_image: ', hsfm.image.clahe_equalize_and_stretch_image, img_gray)
+print('  identical:', np.array_equal(reference, result))
@@ -1,12 +1,27 @@
-import hsfm.io
-import hsfm.image
-import hsfm.trig
-import hsfm.geospatial
-import hsfm.core
-import hsfm.batch
-import hsfm.asp
-import hsfm.utils
-import hsfm.plot
-import hsfm.qc
-import hsfm.metashape
-import hsfm.dataquery
\ No newline at end of file
+import importlib
+
+"""
+Submodules are imported on first use, e.g. hsfm.core, so that modules without
+heavy dependencies like hsfm.trig can be imported without GDAL, bare or hipp.
+"""
+
+__all__ = ['io',
+           'image',
+           'trig',
+           'geospatial',
+           'core',
+           'batch',
+           'asp',
+           'utils',
+           'plot',
+           'qc',
+           'metashape',
+           'dataquery']
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('hsfm.' + name)
+    raise AttributeError("module 'hsfm' has no attribute " + repr(name))
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
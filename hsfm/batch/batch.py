@@ -8,6 +8,7 @@ import pandas as pd
 from datetime import datetime
 import matplotlib.pyplot as plt
 import concurrent.futures
+import multiprocessing
 import psutil
 import pathlib
 import shutil
@@ -236,27 +237,14 @@ def calculate_heading_from_metadata(df,
     lons = df[longitude_column].values
     lats = df[latitude_column].values
     
-    headings = []
-    for i, v in enumerate(lats):
-        try:
-            p0_lon = lons[i]
-            p0_lat = lats[i]
-
-            p1_lon = lons[i+1]
-            p1_lat = lats[i+1]
-        
-            heading = hsfm.geospatial.calculate_heading(p0_lon,p0_lat,p1_lon,p1_lat)
-            headings.append(heading)
+    # assume that the final image is oriented the same as the previous, 
+    # i.e. the flight direction did not change
+    headings  = hsfm.geospatial.calculate_headings(lons, lats)
+    line_ends = np.arange(len(headings)) == len(headings) - 1
+    headings  = hsfm.geospatial.carry_heading_forward(headings, line_ends)
     
-        except:
-            # When the loop reaches the last element, 
-            # assume that the final image is oriented 
-            # the same as the previous, i.e. the flight 
-            # direction did not change
-            headings.append(heading)
-            
-    df = df.sort_values(by=[file_base_name_column], ascending=True)   
     df['heading'] = headings
+    df = df.sort_values(by=[file_base_name_column], ascending=True)   
     
     if for_metashape:
         
@@ -309,7 +297,23 @@ def download_images_to_disk(image_metadata,
                             output_directory = 'output_data/raw_images',
                             image_type = 'pid_tiff',
                             image_file_name_column = 'fileName',
-                            image_extension = '.tif'):
+                            image_extension = '.tif',
+                            max_workers = 8,
+                            base_url = 'https://arcticdata.io/metacat/d1/mn/v2/object/',
+                            max_retries = 5,
+                            timeout = 60,
+                            overwrite = False,
+                            cache = None):
+    """
+    Downloads images concurrently, with at most max_workers requests in flight over 
+    a shared keep-alive session. Interrupted downloads are resumed and existing 
+    images are skipped unless overwrite = True.
+    
+    base_url = 'http://localhost:8000/' # E.g. a local server for testing.
+    cache = '/data/hsfm_cache'          # Archive cache directory or hsfm.io.ArchiveCache. Images are 
+                                        # linked from the cache and only downloaded once across projects.
+                                        # Enabled by default if HSFM_CACHE_DIR is set.
+    """
                             
     if not isinstance(image_metadata, type(pd.DataFrame())):
         df = pd.read_csv(image_metadata)
@@ -318,20 +322,583 @@ def download_images_to_disk(image_metadata,
     
     hsfm.io.create_dir(output_directory)
     
-    
     targets = dict(zip(df[image_type], df[image_file_name_column]))
-    for pid, file_name in targets.items():
-        print('Downloading',file_name, image_type)
-        img_gray = hsfm.core.download_image(pid)
-        out = os.path.join(output_directory, file_name+image_extension)
-        cv2.imwrite(out,img_gray)
-        final_output = hsfm.utils.optimize_geotif(out)
-        os.remove(out)
-        os.rename(final_output, out)
+    session = hsfm.io.create_http_session(pool_size = max_workers)
+    cache = hsfm.io.get_archive_cache(cache)
+    
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for pid, file_name in targets.items():
+            out = os.path.join(output_directory, file_name+image_extension)
+            if os.path.exists(out) and not overwrite:
+                print(out, 'exists. Skipping.')
+                continue
+            print('Downloading',file_name, image_type)
+            future = pool.submit(hsfm.core.download_image_to_disk,
+                                 pid,
+                                 out,
+                                 base_url    = base_url,
+                                 session     = session,
+                                 max_retries = max_retries,
+                                 timeout     = timeout,
+                                 cache       = cache)
+            futures[future] = file_name
+        
+        for future in concurrent.futures.as_completed(futures):
+            file_name = futures[future]
+            try:
+                future.result()
+                print('Downloaded', file_name)
+            except Exception as e:
+                print('Failed to download', file_name, e)
+                failed.append(file_name)
+    
+    session.close()
+    
+    if failed:
+        raise RuntimeError('Failed to download ' + str(len(failed)) + ' images: ' + ', '.join(failed))
     
     return output_directory
         
 
+def preprocess_images_parallel(image_directory,
+                               templates,
+                               output_directory     = 'input_data/preprocessed_images',
+                               manifest_file_name   = None,
+                               image_extension      = '.tif',
+                               max_workers          = None,
+                               memory_per_worker_gb = None,
+                               pick_manually        = False,
+                               qc                   = False,
+                               crop_from_pp_dist    = 11250,
+                               roll_priors          = False,
+                               n_prior_images       = 10,
+                               prior_min_score      = 0.7,
+                               prior_margin         = 100,
+                               detection_options    = None,
+                               **kwargs):
+    """
+    Runs hsfm.core.preprocess_image over all images in image_directory in a process pool
+    and writes a manifest with one row per image.
+    
+    templates = 'input_data/fiducials/' # Template directory or hsfm.core.FiducialTemplateBank.
+    manifest_file_name = None           # Defaults to output_directory/preprocessing_manifest.csv.
+                                        # A .parquet extension writes Parquet instead.
+    max_workers = None                  # Defaults to the available cores, limited by available
+                                        # memory divided by memory_per_worker_gb.
+    pick_manually = True                # Run the interactive pass for queued images once the pool is done.
+                                        # Otherwise queued images keep status 'needs_manual_pick' and
+                                        # can be processed later with pick_fiducials_from_manifest().
+    roll_priors = True                  # All images are from one camera roll. Fiducial search windows are 
+                                        # learned from the first n_prior_images confident detections 
+                                        # (all peak scores >= prior_min_score, no retries) and used for the 
+                                        # remaining images, see hsfm.core.estimate_fiducial_windows().
+    detection_options = {'n_seeds': 3}  # Template matching and retry options, see 
+                                        # hsfm.core.fiducial_detection_options(). prior_min_score
+                                        # and the learned windows are set from the arguments above.
+    
+    Additional keyword arguments are passed to hsfm.core.preprocess_image.
+    """
+    
+    if isinstance(templates, hsfm.core.FiducialTemplateBank):
+        template_directory = templates.template_directory
+    else:
+        template_directory = os.path.abspath(templates)
+    
+    if isinstance(manifest_file_name, type(None)):
+        manifest_file_name = os.path.join(output_directory, 'preprocessing_manifest.csv')
+    
+    hsfm.io.create_dir(output_directory)
+    
+    image_files = sorted(glob.glob(os.path.join(image_directory, '*'+image_extension)))
+    
+    if isinstance(memory_per_worker_gb, type(None)):
+        memory_per_worker_gb = estimate_preprocessing_memory_gb(crop_from_pp_dist)
+    if isinstance(max_workers, type(None)):
+        max_workers = determine_max_workers(memory_per_worker_gb)
+    max_workers = max(1, min(max_workers, len(image_files)))
+    
+    print('Preprocessing', len(image_files), 'images with', max_workers, 'workers')
+    
+    detection_options = hsfm.core.fiducial_detection_options(detection_options,
+                                                             prior_min_score = prior_min_score)
+    job_kwargs = dict(kwargs, 
+                      qc                = qc, 
+                      crop_from_pp_dist = crop_from_pp_dist)
+    
+    def create_preprocess_pool():
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    
+    rows = []
+    pools = {'preprocess': create_preprocess_pool()}
+    try:
+        prior_windows = None
+        if roll_priors:
+            # process images in batches until enough confident detections are available
+            batch_size = max(n_prior_images, max_workers)
+            while image_files and isinstance(prior_windows, type(None)):
+                batch = image_files[:batch_size]
+                image_files = image_files[batch_size:]
+                rows = rows + run_preprocessing_jobs(pools,
+                                                     create_preprocess_pool,
+                                                     batch,
+                                                     template_directory,
+                                                     output_directory,
+                                                     detection_options = detection_options,
+                                                     **job_kwargs)
+                prior_windows = estimate_fiducial_windows_from_manifest_rows(rows,
+                                                                             template_directory,
+                                                                             n_prior_images  = n_prior_images,
+                                                                             prior_min_score = prior_min_score,
+                                                                             margin          = prior_margin)
+            if not isinstance(prior_windows, type(None)):
+                print('Searching fiducial markers within windows learned from', 
+                      n_prior_images, 'images:', prior_windows)
+        
+        rows = rows + run_preprocessing_jobs(pools,
+                                             create_preprocess_pool,
+                                             image_files,
+                                             template_directory,
+                                             output_directory,
+                                             detection_options = dict(detection_options,
+                                                                      prior_windows = prior_windows),
+                                             **job_kwargs)
+    finally:
+        pools['preprocess'].shutdown()
+    
+    return finish_preprocessing_manifest(rows,
+                                         manifest_file_name,
+                                         template_directory,
+                                         output_directory,
+                                         pick_manually     = pick_manually,
+                                         qc                = qc,
+                                         crop_from_pp_dist = crop_from_pp_dist,
+                                         **kwargs)
+
+def download_and_preprocess_images(image_metadata,
+                                   templates,
+                                   raw_image_directory,
+                                   output_directory,
+                                   image_type             = 'pid_tiff',
+                                   image_file_name_column = 'fileName',
+                                   image_extension        = '.tif',
+                                   manifest_file_name     = None,
+                                   max_download_workers   = 8,
+                                   max_workers            = None,
+                                   max_in_flight          = None,
+                                   keep_raw               = True,
+                                   cache                  = None,
+                                   pick_manually          = False,
+                                   roll_priors            = False,
+                                   n_prior_images         = 10,
+                                   prior_min_score        = 0.7,
+                                   prior_margin           = 100,
+                                   crop_from_pp_dist      = 11250,
+                                   detection_options      = None,
+                                   **kwargs):
+    """
+    Pipelined version of download_images_to_disk() followed by preprocess_images_parallel().
+    
+    Each image is passed to a preprocessing worker process as soon as its download completes, 
+    so downloads and preprocessing overlap. At most max_in_flight raw images are downloading 
+    or waiting to be preprocessed at any time, which bounds disk use.
+    
+    keep_raw = False # Delete each raw image once it has been cropped. Raw images that 
+                     # still need manual fiducial marker selection or failed are kept.
+    
+    See preprocess_images_parallel() for the remaining arguments. Returns the manifest.
+    """
+    if not isinstance(image_metadata, type(pd.DataFrame())):
+        df = pd.read_csv(image_metadata)
+    else:
+        df = image_metadata
+    
+    if isinstance(templates, hsfm.core.FiducialTemplateBank):
+        template_directory = templates.template_directory
+    else:
+        template_directory = os.path.abspath(templates)
+    
+    if isinstance(manifest_file_name, type(None)):
+        manifest_file_name = os.path.join(output_directory, 'preprocessing_manifest.csv')
+    
+    hsfm.io.create_dir(raw_image_directory)
+    hsfm.io.create_dir(output_directory)
+    
+    if isinstance(max_workers, type(None)):
+        max_workers = determine_max_workers(estimate_preprocessing_memory_gb(crop_from_pp_dist))
+    if isinstance(max_in_flight, type(None)):
+        max_in_flight = max_download_workers + 2 * max_workers
+    
+    targets = list(zip(df[image_type], df[image_file_name_column]))
+    session = hsfm.io.create_http_session(pool_size = max_download_workers)
+    cache   = hsfm.io.get_archive_cache(cache)
+    
+    detection_options = hsfm.core.fiducial_detection_options(detection_options,
+                                                             prior_min_score = prior_min_score)
+    job_kwargs = dict(kwargs, 
+                      crop_from_pp_dist = crop_from_pp_dist)
+    
+    print('Downloading and preprocessing', len(targets), 'images with', 
+          max_download_workers, 'download and', max_workers, 'preprocessing workers')
+    
+    rows = []
+    prior_windows = None
+    downloads     = {}
+    preprocessing = {}
+    
+    def create_preprocess_pool():
+        # spawn instead of fork, as the download threads are already running.
+        # Scripts calling this need an if __name__ == '__main__': guard.
+        return concurrent.futures.ProcessPoolExecutor(max_workers = max_workers,
+                                                      mp_context  = multiprocessing.get_context('spawn'))
+    
+    download_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_download_workers)
+    pools = {'preprocess': create_preprocess_pool()}
+    submitted_to = {}
+    
+    def preprocess(raw_file_name):
+        future = pools['preprocess'].submit(preprocess_image_worker,
+                                            raw_file_name,
+                                            template_directory,
+                                            output_directory,
+                                            detection_options = dict(detection_options,
+                                                                     prior_windows = prior_windows),
+                                            **job_kwargs)
+        preprocessing[future] = raw_file_name
+        submitted_to[future]  = pools['preprocess']
+    
+    try:
+        while targets or downloads or preprocessing:
+            # keep the number of raw images on disk bounded
+            while targets and len(downloads) + len(preprocessing) < max_in_flight:
+                pid, file_name = targets.pop(0)
+                raw_file_name = os.path.join(raw_image_directory, file_name+image_extension)
+                if os.path.exists(raw_file_name):
+                    preprocess(raw_file_name)
+                    continue
+                print('Downloading', file_name, image_type)
+                future = download_pool.submit(hsfm.core.download_image_to_disk,
+                                              pid,
+                                              raw_file_name,
+                                              session = session,
+                                              cache   = cache)
+                downloads[future] = raw_file_name
+            
+            done, not_done = concurrent.futures.wait(list(downloads) + list(preprocessing),
+                                                     return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    raw_file_name = downloads.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print('Failed to download', raw_file_name, e)
+                        rows.append(failed_manifest_row(raw_file_name, 'download: ' + repr(e)))
+                        continue
+                    preprocess(raw_file_name)
+                else:
+                    raw_file_name = preprocessing.pop(future)
+                    pool = submitted_to.pop(future)
+                    try:
+                        row = future.result()
+                    except Exception as e:
+                        # e.g. a worker process crashed, which breaks the pool for all pending images
+                        print('Failed to preprocess', raw_file_name, repr(e))
+                        rows.append(failed_manifest_row(raw_file_name, 'preprocessing: ' + repr(e)))
+                        if isinstance(e, concurrent.futures.BrokenExecutor):
+                            replace_broken_pool(pools, pool, create_preprocess_pool)
+                        continue
+                    print(row['file_name'], row['status'], 'in', row['elapsed_time_s'], 's')
+                    rows.append(row)
+                    if keep_raw == False and row['status'] in ['detected', 'picked_manually']:
+                        os.remove(raw_file_name)
+                    if roll_priors and isinstance(prior_windows, type(None)):
+                        prior_windows = estimate_fiducial_windows_from_manifest_rows(rows,
+                                                                                     template_directory,
+                                                                                     n_prior_images  = n_prior_images,
+                                                                                     prior_min_score = prior_min_score,
+                                                                                     margin          = prior_margin)
+                        if not isinstance(prior_windows, type(None)):
+                            print('Searching fiducial markers within windows learned from', 
+                                  n_prior_images, 'images:', prior_windows)
+    finally:
+        download_pool.shutdown()
+        pools['preprocess'].shutdown()
+    session.close()
+    
+    return finish_preprocessing_manifest(rows,
+                                         manifest_file_name,
+                                         template_directory,
+                                         output_directory,
+                                         pick_manually     = pick_manually,
+                                         crop_from_pp_dist = crop_from_pp_dist,
+                                         **kwargs)
+
+def finish_preprocessing_manifest(rows,
+                                  manifest_file_name,
+                                  template_directory,
+                                  output_directory,
+                                  pick_manually = False,
+                                  **kwargs):
+    """
+    Writes the manifest rows and runs or reports the manual pass for queued images.
+    """
+    df = pd.DataFrame(rows, columns=preprocessing_manifest_columns())
+    df = df.sort_values(by=['image_file_name']).reset_index(drop=True)
+    write_preprocessing_manifest(df, manifest_file_name)
+    
+    queued = df[df['status'] == 'needs_manual_pick']
+    if not queued.empty:
+        print(len(queued), 'images queued for manual fiducial marker selection:')
+        print(*queued['file_name'].values, sep='\n')
+        if pick_manually:
+            df = pick_fiducials_from_manifest(manifest_file_name,
+                                              template_directory,
+                                              output_directory  = output_directory,
+                                              **kwargs)
+    
+    failed = df[df['status'] == 'failed']
+    if not failed.empty:
+        print(len(failed), 'images failed. See', manifest_file_name)
+    
+    return df
+
+def pick_fiducials_from_manifest(manifest_file_name,
+                                 templates,
+                                 output_directory  = 'input_data/preprocessed_images',
+                                 qc                = False,
+                                 crop_from_pp_dist = 11250,
+                                 **kwargs):
+    """
+    Interactive pass over images with status 'needs_manual_pick' in a manifest written by
+    preprocess_images_parallel(). The manifest is updated in place.
+    """
+    df = read_preprocessing_manifest(manifest_file_name)
+    
+    if isinstance(templates, hsfm.core.FiducialTemplateBank):
+        template_directory = templates.template_directory
+    else:
+        template_directory = templates
+    
+    for index in df[df['status'] == 'needs_manual_pick'].index:
+        row = preprocess_image_worker(df.loc[index, 'image_file_name'],
+                                      template_directory,
+                                      output_directory,
+                                      qc                      = qc,
+                                      crop_from_pp_dist       = crop_from_pp_dist,
+                                      manually_pick_fiducials = True,
+                                      **kwargs)
+        for column, value in row.items():
+            df.loc[index, column] = value
+        # write after every image so that progress is kept if the session is interrupted
+        write_preprocessing_manifest(df, manifest_file_name)
+    
+    return df
+
+def run_preprocessing_jobs(pools,
+                           create_pool,
+                           image_files,
+                           template_directory,
+                           output_directory,
+                           **kwargs):
+    """
+    Submits preprocess_image_worker() jobs to pools['preprocess'] and returns the manifest rows.
+    
+    If a worker process dies, e.g. when it is killed for running out of memory, the pool breaks 
+    and its pending images are recorded as failed. The pool is then replaced with create_pool(), 
+    so that later jobs still run.
+    """
+    pool = pools['preprocess']
+    futures = {}
+    for image_file_name in image_files:
+        future = pool.submit(preprocess_image_worker,
+                             image_file_name,
+                             template_directory,
+                             output_directory,
+                             **kwargs)
+        futures[future] = image_file_name
+    
+    rows = []
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            row = future.result()
+        except Exception as e:
+            print('Failed to preprocess', futures[future], repr(e))
+            rows.append(failed_manifest_row(futures[future], 'preprocessing: ' + repr(e)))
+            if isinstance(e, concurrent.futures.BrokenExecutor):
+                replace_broken_pool(pools, pool, create_pool)
+            continue
+        print(row['file_name'], row['status'], 'in', row['elapsed_time_s'], 's')
+        rows.append(row)
+    return rows
+
+def replace_broken_pool(pools, pool, create_pool):
+    """
+    Replaces pools['preprocess'] with create_pool() if it is still the broken pool, 
+    so that a pool is only replaced once.
+    """
+    if pool is pools['preprocess']:
+        pools['preprocess'].shutdown(wait=False)
+        pools['preprocess'] = create_pool()
+
+def failed_manifest_row(image_file_name, error):
+    return {'image_file_name': image_file_name,
+            'file_name':       os.path.splitext(os.path.split(image_file_name)[-1])[0],
+            'status':          'failed',
+            'error':           error}
+
+def estimate_fiducial_windows_from_manifest_rows(rows,
+                                                 template_directory,
+                                                 n_prior_images  = 10,
+                                                 prior_min_score = 0.7,
+                                                 margin          = 100):
+    """
+    Returns fiducial search windows learned from the first n_prior_images confident 
+    detections in rows, or None if there are not enough.
+    """
+    positions = ['left', 'top', 'right', 'bottom']
+    rows = sorted(rows, key=lambda row: row['image_file_name'])
+    
+    fiducials = []
+    for row in rows:
+        if row['status'] != 'detected' or row.get('retries', 0) > 0:
+            continue
+        scores = [row[position+'_fiducial_score'] for position in positions]
+        if np.nanmin(scores) < prior_min_score:
+            continue
+        fiducials.append([(row[position+'_fiducial_x'], row[position+'_fiducial_y']) for position in positions])
+        
+    if len(fiducials) < n_prior_images:
+        return None
+    
+    templates = hsfm.core.gather_templates(template_directory)
+    return hsfm.core.estimate_fiducial_windows(fiducials[:n_prior_images], templates, margin=margin)
+
+def preprocess_image_worker(image_file_name,
+                            template_directory,
+                            output_directory,
+                            **kwargs):
+    """
+    Preprocesses a single image file and returns a manifest row. Exceptions are 
+    recorded in the row instead of being raised, so that one bad scan does not stop a batch.
+    """
+    file_name = os.path.splitext(os.path.split(image_file_name)[-1])[0]
+    row = {'image_file_name': image_file_name,
+           'file_name':       file_name}
+    
+    start = time.time()
+    try:
+        # cached per process, so templates are only prepared once per worker
+        templates = hsfm.core.gather_templates(template_directory)
+        details = hsfm.core.preprocess_image(None,
+                                             file_name,
+                                             templates,
+                                             output_directory = output_directory,
+                                             image_file_name  = image_file_name,
+                                             manual_fallback  = False,
+                                             return_details   = True,
+                                             **kwargs)
+        row['status']             = details['status']
+        row['retries']            = details['retries']
+        row['noisify']            = details['noisify']
+        row['search']             = details['search']
+        row['cached']             = details['cached']
+        row['intersection_angle'] = details['intersection_angle']
+        row['principal_point_x']  = details['principal_point'][0]
+        row['principal_point_y']  = details['principal_point'][1]
+        for position, fiducial, score in zip(['left', 'top', 'right', 'bottom'], 
+                                             details['fiducials'],
+                                             details['scores']):
+            row[position+'_fiducial_x']     = fiducial[0]
+            row[position+'_fiducial_y']     = fiducial[1]
+            row[position+'_fiducial_score'] = score
+    except Exception as e:
+        row['status'] = 'failed'
+        row['error']  = repr(e)
+    row['elapsed_time_s'] = round(time.time() - start, 2)
+    
+    return row
+
+def preprocessing_manifest_columns():
+    columns = ['image_file_name',
+               'file_name',
+               'status',
+               'retries',
+               'noisify',
+               'search',
+               'cached',
+               'intersection_angle',
+               'principal_point_x',
+               'principal_point_y']
+    for position in ['left', 'top', 'right', 'bottom']:
+        columns.append(position+'_fiducial_x')
+        columns.append(position+'_fiducial_y')
+        columns.append(position+'_fiducial_score')
+    columns = columns + ['elapsed_time_s', 'error']
+    return columns
+
+def write_preprocessing_manifest(df, manifest_file_name):
+    if manifest_file_name.endswith('.parquet'):
+        df.to_parquet(manifest_file_name, index=False)
+    else:
+        df.to_csv(manifest_file_name, index=False)
+
+def read_preprocessing_manifest(manifest_file_name):
+    if manifest_file_name.endswith('.parquet'):
+        df = pd.read_parquet(manifest_file_name)
+    else:
+        df = pd.read_csv(manifest_file_name)
+    df['error'] = df['error'].astype(object)
+    return df
+
+def estimate_preprocessing_memory_gb(crop_from_pp_dist = 11250,
+                                     image_shape       = None,
+                                     matching_threads  = None):
+    """
+    Rough peak memory of one file backed hsfm.core.preprocess_image call. 
+    
+    The cropped square is held in a few uint8 copies (crop, CLAHE, stretch, rotation). 
+    The fiducial windows are held as contrast stretched slices and as padded slices, which 
+    are kept between images, see hsfm.core.reusable_buffer(). Each matching thread 
+    holds buffers for a noisified padded slice, its mask and noise, and the float32 match result.
+    
+    image_shape = (rows, columns) # Defaults to a scan 20% larger than the crop.
+    matching_threads = None       # Defaults to hsfm.core.max_matching_threads.
+    """
+    if isinstance(image_shape, type(None)):
+        image_shape = (int(crop_from_pp_dist * 1.2), int(crop_from_pp_dist * 1.2))
+    if isinstance(matching_threads, type(None)):
+        matching_threads = hsfm.core.max_matching_threads
+    
+    crop_bytes = crop_from_pp_dist**2
+    
+    windows = hsfm.core.determine_fiducial_windows(*image_shape)
+    slice_bytes  = [(w[1] - w[0]) * (w[3] - w[2]) for w in windows]
+    padded_bytes = [(w[1] - w[0] + 500) * (w[3] - w[2] + 500) for w in windows]
+    
+    # noisified slice (uint8), mask (bool), noise (uint8) and match result (float32) per thread
+    thread_bytes = max(padded_bytes) * (1 + 1 + 1 + 4)
+    
+    total_bytes = (5 * crop_bytes 
+                   + sum(slice_bytes) 
+                   + sum(padded_bytes) 
+                   + matching_threads * thread_bytes)
+    return total_bytes / 1e9
+
+def determine_max_workers(memory_per_worker_gb):
+    """
+    Number of workers limited by usable cores and available memory.
+    """
+    try:
+        n_cores = len(psutil.Process().cpu_affinity())
+    except AttributeError:
+        # cpu_affinity is not available on macOS
+        n_cores = psutil.cpu_count(logical=True)
+    available_memory_gb = psutil.virtual_memory().available / 1e9
+    n_memory = int(available_memory_gb // memory_per_worker_gb)
+    return max(1, min(n_cores, n_memory))
+
 def EE_pre_process_images(
         apiKey,
         project_name,
@@ -348,7 +915,8 @@ def EE_pre_process_images(
         template_parent_dir = None,
         output_directory    = '../',
         ee_query_max_results   = 50000,
-        ee_query_label = 'test_download'
+        ee_query_label = 'test_download',
+        cache = None
     ):
     """
     Download and preprocess images from the EE archive.
@@ -375,6 +943,7 @@ def EE_pre_process_images(
         ee_query_max_results (int, optional): [description]. Defaults to 50000.
         ee_query_label (string): The label required by the EE api. Defaults to "test_download" only because thats a previously used value that makes downloading easy for me personally.
         skip_download (bool, optional): Skip download step of this process. Useful if you have called this function before (with the same arguments) and something bad happened. Defaults to False
+        cache (str or hsfm.io.ArchiveCache, optional): Archive cache keyed by entityId. Cached images are linked into the project and only missing ones are downloaded. Enabled by default if HSFM_CACHE_DIR is set. Defaults to None.
     """
 
     output_directory = os.path.join(output_directory, project_name, 'input_data')
@@ -401,16 +970,34 @@ def EE_pre_process_images(
 
     # If you do not download the images, you need to generate the name of the directory that holds the raw tif files
     raw_images_directory_name = 'raw_images'
+    raw_images_directory = os.path.join(download_directory, raw_images_directory_name)
+    cache = hsfm.io.get_archive_cache(cache)
     if download_images:
-        raw_images_directory, calibration_reports_directory = hipp.dataquery.EE_download_images_to_disk(
-            apiKey,
-            ee_results_df['entityId'].tolist(),
-            ee_query_label,
-            download_directory,
-            images_directory_suffix=raw_images_directory_name
-        )
-    else:
-        raw_images_directory = os.path.join(download_directory, raw_images_directory_name)
+        entity_ids = ee_results_df['entityId'].tolist()
+        if not isinstance(cache, type(None)):
+            # link cached images and only download the remaining ones
+            missing_entity_ids = []
+            for entity_id in entity_ids:
+                if entity_id in cache:
+                    cache.link(entity_id, os.path.join(raw_images_directory, entity_id+'.tif'))
+                else:
+                    missing_entity_ids.append(entity_id)
+            print(f'Images found in cache: {len(entity_ids) - len(missing_entity_ids)}')
+            entity_ids = missing_entity_ids
+        if entity_ids:
+            raw_images_directory, calibration_reports_directory = hipp.dataquery.EE_download_images_to_disk(
+                apiKey,
+                entity_ids,
+                ee_query_label,
+                download_directory,
+                images_directory_suffix=raw_images_directory_name
+            )
+        if not isinstance(cache, type(None)):
+            for entity_id in entity_ids:
+                # the same file that is linked from the cache above
+                image_file_name = os.path.join(raw_images_directory, entity_id+'.tif')
+                if os.path.exists(image_file_name):
+                    cache.add(entity_id, image_file_name)
     
     preprocessed_images_directory = raw_images_directory.replace('raw_images', 'cropped_images')
     qc_directory = preprocessed_images_directory.replace("cropped_images", "preprocess_qc")
@@ -530,11 +1117,14 @@ def NAGAP_pre_process_images(project_name,
                              pixel_pitch         = 0.02,
                              focal_length        = None,
                              buffer_m            = 2000,
-                             threshold_px        = 50,
+                             threshold_px        = None,
                              missing_proxy       = None,
                              keep_raw            = True,
                              download_images     = True,
                              image_square_dim    = None,
+                             preprocessing       = 'proxies',
+                             roll_priors         = True,
+                             cache               = None,
                              template_parent_dir = '../input_data/fiducials/nagap',
                              nagap_metadata_csv  = '../input_data/nagap_image_metadata.csv',
                              output_directory    = '../'):
@@ -594,7 +1184,10 @@ def NAGAP_pre_process_images(project_name,
                                                          threshold_px    = threshold_px,
                                                          keep_raw        = keep_raw,
                                                          download_images = download_images,
-                                                         image_square_dim = image_square_dim)
+                                                         image_square_dim = image_square_dim,
+                                                         preprocessing    = preprocessing,
+                                                         roll_priors      = roll_priors,
+                                                         cache            = cache)
                 
                 # in case no day specified in metadata
                 else:
@@ -613,7 +1206,10 @@ def NAGAP_pre_process_images(project_name,
                                                      threshold_px  = threshold_px,
                                                      keep_raw      = keep_raw,
                                                      download_images = download_images,
-                                                     image_square_dim = image_square_dim)
+                                                     image_square_dim = image_square_dim,
+                                                     preprocessing    = preprocessing,
+                                                     roll_priors      = roll_priors,
+                                                     cache            = cache)
         # in case no month specified in metadata                
         else:
             out_dir_roll = os.path.join(output_directory,roll,'mm','dd')
@@ -628,7 +1224,10 @@ def NAGAP_pre_process_images(project_name,
                                              threshold_px  = threshold_px,
                                              keep_raw      = keep_raw,
                                              download_images = download_images,
-                                             image_square_dim = image_square_dim)
+                                             image_square_dim = image_square_dim,
+                                             preprocessing    = preprocessing,
+                                             roll_priors      = roll_priors,
+                                             cache            = cache)
                     
 
                     
@@ -640,23 +1239,80 @@ def NAGAP_pre_process_set(df,
                           focal_length        = None,
                           missing_proxy       = None,
                           buffer_m            = 2000,
-                          threshold_px        = 50,
+                          threshold_px        = None,
                           keep_raw            = True,
                           download_images     = True,
-                          image_square_dim    = None):
+                          image_square_dim    = None,
+                          preprocessing       = 'proxies',
+                          roll_priors         = True,
+                          cache               = None):
+    
+    # threshold_px = None         # Defaults to 50. Like missing_proxy and image_square_dim, only used
+    #                             # for hipp fiducial proxy detection.
+    # preprocessing = 'fiducials' # Template directories contain fiducial marker templates 
+    #                             # (L.jpg, T.jpg, R.jpg, B.jpg). Images are downloaded and preprocessed
+    #                             # in a pipeline with download_and_preprocess_images() instead of 
+    #                             # hipp fiducial proxies, after clustering from the metadata.
+    #                             # Images are cropped around the principal point found with hsfm 
+    #                             # template matching, so threshold_px, missing_proxy and 
+    #                             # image_square_dim can not be used and raise a ValueError.
+    #                             # The default 'proxies' path stays sequential, as hipp derives
+    #                             # image_square_dim from all images of the set.
+    # roll_priors = True          # With preprocessing = 'fiducials', learn fiducial search windows 
+    #                             # from the first confident detections of the set.
+    # cache = '/data/hsfm_cache'  # Archive cache shared between projects, see download_images_to_disk().
     
     # TODO
     # check if image directory already contains raw images, else skip
                           
+        if preprocessing == 'fiducials':
+            proxy_arguments = {'threshold_px':     threshold_px,
+                               'missing_proxy':    missing_proxy,
+                               'image_square_dim': image_square_dim}
+            proxy_arguments = [k for k, v in proxy_arguments.items() if not isinstance(v, type(None))]
+            if proxy_arguments:
+                raise ValueError(', '.join(proxy_arguments) + " can not be used with "
+                                 "preprocessing = 'fiducials', which does not detect fiducial proxies")
+        elif isinstance(threshold_px, type(None)):
+            threshold_px = 50
+        
+        cache = hsfm.io.get_archive_cache(cache)
+        
         for i,v in enumerate(template_types):
             df_tmp = df[df['fiducial_proxy_type']  == v].copy()
             if not df_tmp.empty:
                 if len(df_tmp.index) > 2:
+                    if download_images == True and preprocessing == 'fiducials':
+                        # clustering only needs the metadata, it runs first on the main thread 
+                        # as its qc plots use pyplot, which is not thread safe
+                        if isinstance(focal_length, type(None)):
+                            focal_length = df_tmp['focal_length'].values[0]
+                        hsfm.core.determine_image_clusters(df_tmp,
+                                                           pixel_pitch      = pixel_pitch,
+                                                           focal_length     = focal_length,
+                                                           output_directory = os.path.join(output_directory,'sfm'),
+                                                           buffer_m         = buffer_m)
+                        hsfm.batch.download_and_preprocess_images(df_tmp,
+                                                                  template_dirs[i],
+                                                                  os.path.join(output_directory, v+'_raw_images'),
+                                                                  os.path.join(output_directory, v+'_cropped_images'),
+                                                                  keep_raw    = keep_raw,
+                                                                  cache       = cache,
+                                                                  roll_priors = roll_priors)
+                        continue
+                    
                     if download_images == True :
-                        image_directory = hipp.dataquery.NAGAP_download_images_to_disk(
-                                                         df_tmp,
-                                                         output_directory=os.path.join(output_directory,
-                                                                                       v+'_raw_images'))
+                        if not isinstance(cache, type(None)):
+                            image_directory = hsfm.batch.download_images_to_disk(
+                                                             df_tmp,
+                                                             output_directory=os.path.join(output_directory,
+                                                                                           v+'_raw_images'),
+                                                             cache = cache)
+                        else:
+                            image_directory = hipp.dataquery.NAGAP_download_images_to_disk(
+                                                             df_tmp,
+                                                             output_directory=os.path.join(output_directory,
+                                                                                           v+'_raw_images'))
                         template_directory = template_dirs[i]
                         image_square_dim = hipp.batch.preprocess_with_fiducial_proxies(
                                                       image_directory,
@@ -1254,7 +1910,14 @@ def batch_process(project_name,
                   cleanup                 = True,
                   attempts_to_adjust_cams = 2,
                   check_subsets           = True,
-                  overwrite               = False):
+                  overwrite               = False,
+                  n_jobs                  = 1,
+                  job_index               = 0):
+    
+    """
+    n_jobs    = 4 # split the clusters into this many jobs of similar total image count,
+    job_index = 0 # e.g. one per machine, and only process the clusters of this job.
+    """
     
     output_directory = os.path.join(input_directory, project_name, 'input_data')
     
@@ -1268,7 +1931,7 @@ def batch_process(project_name,
     image_files = sorted(glob.glob(image_files))
     
     input_directories = os.path.join(output_directory,'*','*','*','sfm/cl*')
-    batches = sorted(glob.glob(input_directories))
+    batches = sorted([i for i in glob.glob(input_directories) if os.path.isdir(i)])
     camera_model_xml_files = sorted(glob.glob(os.path.join(output_directory,'camera_models','*.xml')))
     if len(camera_model_xml_files) ==0:
         print('No camera models found in ', os.path.join(output_directory,'camera_models'))
@@ -1280,6 +1943,11 @@ def batch_process(project_name,
     else:
         print("\nCan't find reference DEM at",output_path)
         sys.exit(0) 
+    
+    if n_jobs > 1:
+        batches = hsfm.batch.assign_clusters_to_jobs(batches, n_jobs)[job_index]
+        print('Processing', len(batches), 'clusters in job', job_index, 'of', n_jobs)
+        
     for i in batches:
         
         ## TODO add better logging here and print the error message
@@ -1318,3 +1986,54 @@ def batch_process(project_name,
         print("Elapsed time", str(datetime.now() - now), '\n\n')
         print("DONE")
 
+def assign_clusters_to_jobs(cluster_directories, n_jobs):
+    """
+    Distributes cluster directories over n_jobs lists with similar total image counts,
+    assigning the largest clusters first to the least loaded job.
+    """
+    sizes = []
+    for cluster_directory in cluster_directories:
+        metadata_file = os.path.join(cluster_directory, 'metashape_metadata.csv')
+        try:
+            sizes.append(len(pd.read_csv(metadata_file)))
+        except OSError:
+            sizes.append(0)
+    
+    jobs  = [[] for i in range(n_jobs)]
+    loads = [0] * n_jobs
+    for k in np.argsort(sizes, kind='stable')[::-1]:
+        job = int(np.argmin(loads))
+        jobs[job].append(cluster_directories[k])
+        loads[job] += sizes[k]
+    return [sorted(job) for job in jobs]
+
+def merge_cluster_dems(sfm_directory,
+                       dem_pattern = '**/*trans_source-DEM.tif',
+                       verbose     = False):
+    """
+    Mosaics the DEMs of sub-blocks split from one cluster (e.g. cluster_003_00, 
+    cluster_003_01) with ASP dem_mosaic into mosaics/cluster_003_mosaic.tif in sfm_directory.
+    The most recent DEM matching dem_pattern is used for each sub-block.
+    """
+    sub_blocks = sorted(glob.glob(os.path.join(sfm_directory, 'cluster_[0-9][0-9][0-9]_[0-9][0-9]')))
+    clusters = {}
+    for sub_block in sub_blocks:
+        dems = glob.glob(os.path.join(sub_block, dem_pattern), recursive=True)
+        if len(dems) == 0:
+            print('No DEM found for', sub_block)
+            continue
+        cluster = os.path.basename(sub_block)[:len('cluster_000')]
+        clusters.setdefault(cluster, []).append(max(dems, key=os.path.getmtime))
+    
+    # kept apart from the cluster directories picked up by batch_process
+    mosaic_directory = hsfm.io.create_dir(os.path.join(sfm_directory, 'mosaics'))
+    
+    output_files = []
+    for cluster, dems in clusters.items():
+        output_file = os.path.join(mosaic_directory, cluster + '_mosaic.tif')
+        call = ['dem_mosaic']
+        call.extend(dems)
+        call.extend(['-o', output_file])
+        hsfm.utils.run_command(call, verbose=verbose)
+        output_files.append(output_file)
+    return output_files
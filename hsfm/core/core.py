@@ -2,7 +2,6 @@ import shutil
 import numpy as np
 import math
 import pandas as pd
-from urllib.request import urlopen
 import cv2
 from skimage import exposure
 import shapely
@@ -17,6 +16,12 @@ import matplotlib.pyplot as plt
 import matplotlib._color_data as mcd
 import contextily as ctx
 import time
+import json
+import hashlib
+import threading
+import tempfile
+import functools
+import concurrent.futures
 cycle = list(mcd.XKCD_COLORS.values())
 
 import hsfm
@@ -44,7 +49,12 @@ def get_gcp_polygon(fn):
 
 def create_overlap_list(gcp_directory,
                         image_directory,
-                        output_directory):
+                        output_directory,
+                        min_overlap_fraction = 0):
+    """
+    min_overlap_fraction = 0.1 # only pair images whose footprints overlap by at least 
+                               # this fraction of the smaller footprint.
+    """
     
     output_directory = os.path.join(output_directory, 'ba')
     
@@ -57,24 +67,42 @@ def create_overlap_list(gcp_directory,
     
     gcp_files = glob.glob(os.path.join(gcp_directory,'*.gcp'))
     image_files = glob.glob(os.path.join(image_directory,'*.tif'))
+    image_files_by_name = {os.path.splitext(os.path.basename(fn))[0]: fn for fn in image_files}
     
     footprints = []
+    cameras    = []
     for fn in gcp_files:
         gdf = get_gcp_polygon(fn)
-        footprints.append(gdf)
-        
+        footprints.append(gdf.geometry.values[0])
+        cameras.append(gdf['camera'].values[0])
+    footprints = gpd.GeoSeries(footprints)
+    
     pairs=[]
-    for a, b in itertools.combinations(footprints, 2):
-        result = hsfm.geospatial.compare_footprints(a, b)
-        if result == 1:
-            c = hsfm.io.retrieve_match(a['camera'].values[0] , image_files)
-            d = hsfm.io.retrieve_match(b['camera'].values[0] , image_files)
-            pairs.append((c,d))
+    missing = set()
+    for a, b in zip(*hsfm.geospatial.sindex_query_pairs(footprints)):
+        area = footprints.iloc[a].intersection(footprints.iloc[b]).area
+        if area <= 0:
+            continue
+        if area < min_overlap_fraction * min(footprints.iloc[a].area, footprints.iloc[b].area):
+            continue
+        c = image_files_by_name.get(cameras[a]) or hsfm.io.retrieve_match(cameras[a], image_files)
+        d = image_files_by_name.get(cameras[b]) or hsfm.io.retrieve_match(cameras[b], image_files)
+        if isinstance(c, type(None)) or isinstance(d, type(None)):
+            missing.update([camera for camera, match in [(cameras[a], c), (cameras[b], d)]
+                            if isinstance(match, type(None))])
+            continue
+        pairs.append((c,d))
+    
+    if missing:
+        print('WARNING: skipped overlapping pairs for', len(missing),
+              'cameras without an image in', image_directory+':', ', '.join(sorted(missing)))
 
     pairs = sorted(list(set(pairs)))
-    for i in pairs:
-        with open(filename_out, 'a') as out:
-            out.write(i[0] + ' '+ i[1]+'\n')
+    return write_overlap_list(pairs, filename_out)
+
+def write_overlap_list(pairs, filename_out):
+    with open(filename_out, 'w') as out:
+        out.write(''.join(i[0] + ' '+ i[1]+'\n' for i in pairs))
     return filename_out
 
 
@@ -104,11 +132,7 @@ def create_overlap_list_from_match_files(match_files_directory,
         
     # creates full set from .match and clean.match pairs
     pairs = sorted(list(set(pairs)))
-    for i in pairs:
-        with open(filename_out, 'a') as out:
-            out.write(i[0] + ' '+ i[1]+'\n')
-            
-    return filename_out
+    return write_overlap_list(pairs, filename_out)
 
 def determine_flight_lines(df, 
                            cutoff_angle          = 30,
@@ -126,41 +150,44 @@ def determine_flight_lines(df,
     df['heading_diff'] = df['heading_diff'].fillna(0)
     df = df.reset_index(drop=True)
     
-    flights_tmp = []
-    tmp_df = pd.DataFrame()
+    if df.empty:
+        return []
     
-    for row in df.iterrows():
-        if row[1]['heading_diff'] < cutoff_angle:
-            tmp_df = pd.concat([tmp_df, pd.DataFrame(row[1])],axis=1)
-        else:
-            tmp_df = pd.concat([tmp_df, pd.DataFrame(row[1])],axis=1)
-            tmp_df = tmp_df.T
-            flights_tmp.append(tmp_df)
-            tmp_df = pd.DataFrame()
-    tmp_df = tmp_df.T
-    if not tmp_df.empty:
-        flights_tmp.append(tmp_df.reset_index(drop=True))
-
-    flights = []
-    for i,v in enumerate(flights_tmp):
-        if len(v) == 1:
-            tmp_df = pd.concat([flights_tmp[i-1],v])
-            flights.pop()
-            flights.append(tmp_df.reset_index(drop=True))
-        else:
-            flights.append(v.reset_index(drop=True))
+    # a flight line ends after each image where the heading changes by more than cutoff_angle
+    breaks  = (df['heading_diff'].values >= cutoff_angle).astype(int)
+    segment = np.concatenate([[0], np.cumsum(breaks[:-1])])
     
+    # merge single image segments into the preceding flight line, or the following one at the start
+    sizes   = np.bincount(segment)
+    ids     = np.arange(len(sizes))
+    targets = pd.Series(np.where(sizes > 1, ids, np.nan)).ffill().bfill()
+    targets = targets.fillna(pd.Series(ids)).values.astype(int)
+    
+    # the last image of a flight line points towards the next line
+    flight_line = targets[segment]
+    line_ends   = np.append(flight_line[1:] != flight_line[:-1], True)
+    df['heading'] = hsfm.geospatial.carry_heading_forward(df['heading'].values, line_ends)
+    df['next_heading'] = df['heading'].shift(-1)
+    df['heading_diff'] = abs(df['next_heading'] - df['heading'])
+    df['heading_diff'] = df['heading_diff'].fillna(0)
+    
+    flights = [v.reset_index(drop=True) for i, v in df.groupby(flight_line, sort=True)]
     return flights
     
     
 def evaluate_image_frame(grayscale_unit8_image_array,frame_size=0.07):
-    
-    x = grayscale_unit8_image_array.shape[1]
-    y = grayscale_unit8_image_array.shape[0]
+    """
+    grayscale_unit8_image_array can also be an image file name, in which case only 
+    the frame is read from disk.
+    """
     
     img = grayscale_unit8_image_array
     
-    window = [0,y,0,x]
+    if isinstance(img, str):
+        y, x = hsfm.io.get_image_shape(img)
+    else:
+        x = img.shape[1]
+        y = img.shape[0]
     
     slice_left_top = frame_size
     slice_right_bottom = 1-frame_size
@@ -170,10 +197,12 @@ def evaluate_image_frame(grayscale_unit8_image_array,frame_size=0.07):
     y_slice_top = int(y * slice_left_top)
     y_slice_bottom = int(y * slice_right_bottom)
     
-    left =   img[0:y,              0:x_slice_left]
-    top =    img[0:y_slice_top,    0:x]
-    right =  img[0:y,              x_slice_right:x] 
-    bottom = img[y_slice_bottom:y, 0:x]
+    frame_windows = [[0,              y,           0,             x_slice_left],
+                     [0,              y_slice_top, 0,             x           ],
+                     [0,              y,           x_slice_right, x           ],
+                     [y_slice_bottom, y,           0,             x           ]]
+    
+    left, top, right, bottom = slice_image_frame(img, frame_windows)
     
     stats = {'left':np.median(left), 
              'right':np.median(right), 
@@ -257,20 +286,12 @@ def calculate_corner_coordinates(camera_lat_lon_wgs84_center_coordinates,
     camera_utm_lon = u[0]
     
     # Calculate upper left, upper right, lower right, lower left corner coordinates as (lat,lon)
-    UL, UR, LR, LL = hsfm.trig.calculate_corner(camera_utm_lat,camera_utm_lon,half_width_m, half_height_m, heading)
-
-    #Calculate corner coordinates in UTM
-    corners = [UL, UR, LR, LL]
-    corner_points_wgs84 = []
-    corner_lons = []
-    corner_lats = []
-    
-    for coordinate in corners:
-        coordinate_wgs84 = utm.to_latlon(coordinate[0],coordinate[1],u[2],u[3])
-        lat = coordinate_wgs84[0]
-        lon = coordinate_wgs84[1]
-        corner_lons.append(lon)
-        corner_lats.append(lat)
+    corners = hsfm.trig.calculate_corners(camera_utm_lat,camera_utm_lon,half_width_m, half_height_m, heading)[0]
+
+    #Convert corner coordinates from UTM
+    corner_lats, corner_lons = utm.to_latlon(corners[:,0],corners[:,1],u[2],u[3])
+    corner_lons = list(corner_lons)
+    corner_lats = list(corner_lats)
         
     corner_elevations = hsfm.geospatial.sample_dem(corner_lons, corner_lats, reference_dem)
     
@@ -547,37 +568,202 @@ def subset_images_for_download(df, subset=None):
             df = df[df['image_index_number'].isin(subset)]
     return df
     
-def download_image(pid):
-    base_url = 'https://arcticdata.io/metacat/d1/mn/v2/object/'
-    url = base_url+pid
-    resp = urlopen(url)
-    image = np.asarray(bytearray(resp.read()), dtype="uint8")
-    image = cv2.imdecode(image, cv2.IMREAD_GRAYSCALE)
+def download_image_to_disk(pid,
+                           output_file_name,
+                           base_url    = 'https://arcticdata.io/metacat/d1/mn/v2/object/',
+                           session     = None,
+                           max_retries = 5,
+                           timeout     = 60,
+                           cache       = None):
+    """
+    Downloads an image with hsfm.io.download_file, which streams the response to disk 
+    in chunks, retries and resumes partial downloads, and converts it to a tiled 
+    grayscale GeoTIFF. Single band 8-bit scans are never fully held in memory.
+    
+    cache = hsfm.io.ArchiveCache() # Link the image from the cache, which is keyed by pid,
+                                   # and only download it if it is not cached yet.
+    """
+    if not isinstance(cache, type(None)):
+        download = functools.partial(download_image_to_disk,
+                                     pid,
+                                     base_url    = base_url,
+                                     session     = session,
+                                     max_retries = max_retries,
+                                     timeout     = timeout)
+        return cache.fetch(pid, output_file_name, download)
+    
+    raw_file_name = output_file_name + '.download'
+    hsfm.io.download_file(base_url+pid,
+                          raw_file_name,
+                          session     = session,
+                          max_retries = max_retries,
+                          timeout     = timeout)
+    try:
+        hsfm.io.convert_to_tiled_tif(raw_file_name, output_file_name)
+    except ValueError:
+        # keep the raw file for inspection, but do not leave a partial output behind
+        if os.path.exists(output_file_name):
+            os.remove(output_file_name)
+        raise
+    os.remove(raw_file_name)
+    return output_file_name
+
+def download_image(pid,
+                   base_url = 'https://arcticdata.io/metacat/d1/mn/v2/object/',
+                   session  = None):
+    """
+    Returns the downloaded image as grayscale uint8 array. The response is streamed 
+    to a temporary file instead of being buffered in memory before decoding.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        raw_file_name = os.path.join(tmp, pid.replace('/', '_'))
+        hsfm.io.download_file(base_url+pid, raw_file_name, session=session)
+        image = cv2.imread(raw_file_name, cv2.IMREAD_GRAYSCALE)
     return image
     
 def slice_image_frame(grayscale_unit8_image_array, windows):
-    window_left   = windows[0]
-    window_top    = windows[1]
-    window_right  = windows[2]
-    window_bottom = windows[3]
-    
+    """
+    Returns one slice per window, given as [row_start, row_end, col_start, col_end].
+    If grayscale_unit8_image_array is an image file name, only the windows are read from disk.
+    """
     img_gray = grayscale_unit8_image_array
     
-    left_slice = img_gray[window_left[0]:window_left[1],window_left[2]:window_left[3]]
-    top_slice = img_gray[window_top[0]:window_top[1],window_top[2]:window_top[3]]
-    right_slice = img_gray[window_right[0]:window_right[1],window_right[2]:window_right[3]]
-    bottom_slice = img_gray[window_bottom[0]:window_bottom[1],window_bottom[2]:window_bottom[3]]
+    if isinstance(img_gray, str):
+        return hsfm.io.read_image_windows(img_gray, windows)
+    
+    slices = [img_gray[w[0]:w[1], w[2]:w[3]] for w in windows]
+    return slices
+
+def determine_fiducial_windows(image_height, image_width):
+    """
+    Returns the left, top, right and bottom windows searched for fiducial markers
+    as [row_start, row_end, col_start, col_end].
+    """
+    half_image_height     = int(image_height / 2)
+    quarter_image_height  = int(half_image_height / 2)
+
+    half_image_width     = int(image_width / 2)
+    quarter_image_width  = int(half_image_width / 2)
+    
+    window_left = [half_image_height - quarter_image_height,
+                   half_image_height + quarter_image_height,
+                   0, 
+                   half_image_width - quarter_image_width]
+
+    window_top = [0,
+                  half_image_height - quarter_image_height,
+                  half_image_width - quarter_image_width,
+                  half_image_width + quarter_image_width]
+
+    window_right = [half_image_height - quarter_image_height,
+                    half_image_height + quarter_image_height,
+                    half_image_width + quarter_image_width,
+                    image_width]
+
+
+    window_bottom = [half_image_height + quarter_image_height,
+                     image_height,
+                     half_image_width - quarter_image_width,
+                     half_image_width + quarter_image_width]
+                     
+    windows = [window_left, window_top, window_right, window_bottom]
+    return windows
+
+def stretch_image_frame_slices(grayscale_unit8_image_array, windows, min_max=(0.1, 99.9)):
+    """
+    Slices the image frame and stretches the slices with the percentiles of the full image,
+    which gives the same result as slicing the stretched full image.
+    If grayscale_unit8_image_array is an image file name, the percentiles are computed 
+    from its histogram and only the windows are read from disk.
+    """
+    img_gray = grayscale_unit8_image_array
     
-    slices = [left_slice, top_slice, right_slice, bottom_slice]
+    if isinstance(img_gray, str):
+        histogram = hsfm.io.image_histogram(img_gray)
+        in_range = hsfm.image.percentiles_from_histogram(histogram, min_max)
+    else:
+        in_range = hsfm.image.image_percentiles(img_gray, min_max)
+        
+    slices = slice_image_frame(img_gray, windows)
+    slices = [hsfm.image.img_linear_stretch(i, in_range=in_range) for i in slices]
     return slices
 
-def gather_templates(template_directory):
-    left_template = os.path.join(template_directory,'L.jpg')
-    top_template = os.path.join(template_directory,'T.jpg')
-    right_template = os.path.join(template_directory,'R.jpg')
-    bottom_template = os.path.join(template_directory,'B.jpg')
-    templates = [left_template, top_template, right_template, bottom_template]
-    return templates
+class FiducialTemplateBank:
+    """
+    Fiducial marker templates read, stretched and noisified once.
+    
+    Indexes like the list of template files it replaces, in order left, top, 
+    right, bottom, but returns uint8 arrays ready for template matching.
+    The noise added to the templates is seeded, so that a bank is reproducible.
+    """
+    template_file_names = ['L.jpg', 'T.jpg', 'R.jpg', 'B.jpg']
+    
+    def __init__(self, template_directory, seed=0):
+        self.template_directory = os.path.abspath(template_directory)
+        self.seed = seed
+        self.template_files = [os.path.join(self.template_directory, i) for i in self.template_file_names]
+        self.templates = [prepare_template(i, seed=seed) for i in self.template_files]
+        self.hash = hash_templates(self.templates)
+        
+    def __getitem__(self, index):
+        return self.templates[index]
+    
+    def __len__(self):
+        return len(self.templates)
+    
+    def __iter__(self):
+        return iter(self.templates)
+
+# one template bank per template directory and process
+_template_banks = {}
+
+def gather_templates(template_directory, seed=0):
+    """
+    Returns the FiducialTemplateBank for template_directory, which is only
+    read from disk the first time it is requested in a given process.
+    """
+    key = (os.path.abspath(template_directory), seed)
+    if key not in _template_banks:
+        _template_banks[key] = FiducialTemplateBank(template_directory, seed=seed)
+    return _template_banks[key]
+
+def hash_templates(templates):
+    """
+    Returns a hash identifying a template set, e.g. for fiducial_detection_cache_key().
+    """
+    if isinstance(templates, FiducialTemplateBank):
+        return templates.hash
+    hashes = []
+    for template in templates:
+        if isinstance(template, str):
+            hashes.append(hsfm.io.hash_file(template))
+        else:
+            hashes.append(hsfm.io.hash_array(template))
+    return hashlib.blake2b(''.join(hashes).encode(), digest_size=16).hexdigest()
+
+def fiducial_detection_cache_key(grayscale_unit8_image_array, templates, parameters):
+    """
+    Cache key from the image content, the template set and the detection parameters.
+    grayscale_unit8_image_array can also be an image file name.
+    """
+    img_gray = grayscale_unit8_image_array
+    if isinstance(img_gray, str):
+        image_hash = hsfm.io.hash_file(img_gray)
+    else:
+        image_hash = hsfm.io.hash_array(img_gray)
+    parameters = json.dumps(parameters, sort_keys=True, default=lambda o: o.tolist())
+    key = '|'.join([image_hash, hash_templates(templates), parameters])
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+def prepare_template(template_file, seed=None):
+    template = cv2.imread(template_file)
+    template = cv2.cvtColor(template,cv2.COLOR_BGR2GRAY)
+    template = hsfm.image.img_linear_stretch(template)
+    template = hsfm.core.noisify_template(template, rng=seed)
+    template = np.ascontiguousarray(template, dtype=np.uint8)
+    # shared between calls, so guard against in place modification
+    template.setflags(write=False)
+    return template
     
 def pick_fiducials_manually(image_file_name=None, 
                             image_array=None, 
@@ -592,10 +778,7 @@ def pick_fiducials_manually(image_file_name=None,
     if isinstance(image_array, np.ndarray):
         hsfm.io.create_dir('tmp/')
         temp_out = os.path.join('tmp/', 'temporary_image.tif')
-        cv2.imwrite(temp_out,image_array)
-        temp_out_optimized = hsfm.utils.optimize_geotif(temp_out)
-        os.remove(temp_out)
-        os.rename(temp_out_optimized, temp_out)
+        hsfm.io.write_tiled_tif(image_array, temp_out)
         
         image_file_name = temp_out
           
@@ -613,6 +796,38 @@ def pick_fiducials_manually(image_file_name=None,
             condition = False 
     
     
+def fiducial_detection_options(detection_options=None, **options):
+    """
+    Returns the template matching and retry options for preprocess_image(), with defaults 
+    for those not set in detection_options or options.
+    
+    pyramid_scale = 4           #Coarse-to-fine fiducial template matching, see template_match().
+    retry_engine = 'cascade'    #Re-attempt detection with one fiducial noisified at a time until 
+                                #the angle is within limits, instead of evaluating all noisified 
+                                #variants concurrently, see detect_fiducials_with_retries().
+    n_seeds = 3                 #Noisified variants per fiducial evaluated by the concurrent engine.
+    seed = 0                    #Seed for noisified variants. None for non reproducible noise.
+    prior_windows = windows     #Tight search windows, e.g. from estimate_fiducial_windows(). Falls back
+                                #to the full windows if a peak score is below prior_min_score or the
+                                #intersection angle is not within limits.
+    """
+    defaults = {'pyramid_scale':   None,
+                'retry_engine':    'concurrent',
+                'n_seeds':         1,
+                'seed':            0,
+                'prior_windows':   None,
+                'prior_min_score': 0.7}
+    
+    if isinstance(detection_options, type(None)):
+        detection_options = {}
+    options = dict(detection_options, **options)
+    
+    unknown = sorted(set(options) - set(defaults))
+    if unknown:
+        raise ValueError('Unknown fiducial detection options: ' + ', '.join(unknown))
+    
+    return dict(defaults, **options)
+    
 def preprocess_image(image_array, 
                      file_name, 
                      templates, 
@@ -624,10 +839,25 @@ def preprocess_image(image_array,
                      manually_pick_fiducials=False,
                      side = None,
                      expected_angle=90.0,
-                     angle_threshold=0.2):
+                     angle_threshold=0.2,
+                     detection_options=None,
+                     manual_fallback=True,
+                     return_details=False,
+                     cache=None):
     """
     side = 'left','top','right' #Determines position of frame opposite to flight direction. 
                                 #If none determines side of frame with largest black border.
+    image_array = None          #Reads only the fiducial search windows and the cropped region
+                                #from image_file_name, instead of holding the full scan in memory.
+    detection_options = {'pyramid_scale': 4, 'n_seeds': 3}
+                                #Template matching and retry options, see fiducial_detection_options().
+    manual_fallback = False     #Do not launch manual fiducial selection if detection fails, 
+                                #return with status 'needs_manual_pick' instead.
+    return_details = True       #Return dict with intersection_angle, fiducials, principal_point,
+                                #scores, retries and status instead of the intersection angle only.
+    cache = 'fiducials.sqlite'  #Cache detection results by image content, templates and parameters in
+                                #a hsfm.io.ResultCache. On a cache hit detection is skipped, as is
+                                #cropping if the output image already exists.
     """
                      
     # TODO clean this up
@@ -635,136 +865,198 @@ def preprocess_image(image_array,
     angle_min = expected_angle-angle_threshold
     angle_max = expected_angle+angle_threshold
     
-    img_gray = image_array
-    
-    half_image_height     = int(img_gray.shape[0] / 2)
-    quarter_image_height  = int(half_image_height / 2)
-
-    half_image_width     = int(img_gray.shape[1] / 2)
-    quarter_image_width  = int(half_image_width / 2)
-    
-    window_left = [half_image_height - quarter_image_height,
-                   half_image_height + quarter_image_height,
-                   0, 
-                   half_image_width - quarter_image_width]
-
-    window_top = [0,
-                  half_image_height - quarter_image_height,
-                  half_image_width - quarter_image_width,
-                  half_image_width + quarter_image_width]
-
-    window_right = [half_image_height - quarter_image_height,
-                    half_image_height + quarter_image_height,
-                    half_image_width + quarter_image_width,
-                    img_gray.shape[1]]
-
-
-    window_bottom = [half_image_height + quarter_image_height,
-                     img_gray.shape[0],
-                     half_image_width - quarter_image_width,
-                     half_image_width + quarter_image_width]
-                     
-    windows = [window_left, window_top, window_right, window_bottom]
-    
-    if isinstance(side, type(None)):
-        side = hsfm.core.evaluate_image_frame(img_gray)
-    
-    if manually_pick_fiducials:
+    detection_options = fiducial_detection_options(detection_options)
+    pyramid_scale   = detection_options['pyramid_scale']
+    retry_engine    = detection_options['retry_engine']
+    n_seeds         = detection_options['n_seeds']
+    seed            = detection_options['seed']
+    prior_windows   = detection_options['prior_windows']
+    prior_min_score = detection_options['prior_min_score']
+    
+    if isinstance(image_array, type(None)):
+        # file backed, functions below read windows from disk when passed the file name
+        img_gray = image_file_name
+        image_height, image_width = hsfm.io.get_image_shape(image_file_name)
+    else:
+        img_gray = image_array
+        image_height, image_width = img_gray.shape
+    
+    windows = determine_fiducial_windows(image_height, image_width)
+    
+    retries = 0
+    status  = 'detected'
+    scores  = [np.nan, np.nan, np.nan, np.nan]
+    noisify = None
+    search  = None
+    
+    cached    = None
+    cache_key = None
+    if cache and not manually_pick_fiducials:
+        if isinstance(cache, str):
+            cache = hsfm.io.ResultCache(cache)
+        parameters = dict(detection_options,
+                          invisible_fiducial = invisible_fiducial,
+                          expected_angle     = expected_angle,
+                          angle_threshold    = angle_threshold)
+        cache_key = fiducial_detection_cache_key(img_gray, templates, parameters)
+        cached = cache.get(cache_key)
+    
+    if cached:
+        print('Using cached fiducial marker detection for', file_name)
+        fiducials          = [tuple(i) for i in cached['fiducials']]
+        principal_point    = tuple(cached['principal_point'])
+        intersection_angle = cached['intersection_angle']
+        scores             = cached['scores']
+        retries            = cached['retries']
+        noisify            = cached['noisify']
+        search             = cached['search']
+        status             = cached['status']
+        
+    elif manually_pick_fiducials:
         if image_file_name:
             principal_point, intersection_angle, fiducials = pick_fiducials_manually(image_file_name=image_file_name)
         else:
             principal_point, intersection_angle, fiducials = pick_fiducials_manually(image_array=img_gray)
+        status = 'picked_manually'
     
     else:
-        fiducials, principal_point = detect_fiducials_and_principal_point(windows, 
-                                                                          templates, 
-                                                                          img_gray,
-                                                                          invisible_fiducial=invisible_fiducial)
-        # QC routine
-        intersection_angle = determine_intersection_angle(fiducials)
-        print('Principal point intersection angle:', intersection_angle)
-    
-        if intersection_angle > angle_max or intersection_angle < angle_min:
-            print("Warning: intersection angle at principle point is not within orthogonality limits.")
-            print('Re-attempting fiducial marker detection.')
-            print("Processing left fiducial.")
-            fiducials, principal_point = detect_fiducials_and_principal_point(windows, 
-                                                                              templates, 
-                                                                              img_gray,
-                                                                              noisify='left',
-                                                                              invisible_fiducial=invisible_fiducial)
-            intersection_angle = determine_intersection_angle(fiducials)
-            print('New intersection angle:',intersection_angle)
-            if intersection_angle > angle_max or intersection_angle < angle_min:
-                print("Processing top fiducial.")
-                fiducials, principal_point = detect_fiducials_and_principal_point(windows, 
-                                                                                  templates, 
-                                                                                  img_gray,
-                                                                                  noisify='top',
-                                                                                  invisible_fiducial=invisible_fiducial)
-                intersection_angle = determine_intersection_angle(fiducials)
-                print('New intersection angle:',intersection_angle)
-                if intersection_angle > angle_max or intersection_angle < angle_min:
-                    print("Processing right fiducial.")
-                    fiducials, principal_point = detect_fiducials_and_principal_point(windows, 
-                                                                                      templates, 
-                                                                                      img_gray,
-                                                                                      noisify='right',
-                                                                                      invisible_fiducial=invisible_fiducial)
+        if isinstance(prior_windows, type(None)):
+            candidate_windows = [('full', windows)]
+        else:
+            candidate_windows = [('prior', prior_windows), ('full', windows)]
+        
+        for search, search_windows in candidate_windows:
+            # enhance contrast once, the slices are not modified by the detection attempts below
+            slices = stretch_image_frame_slices(img_gray, search_windows)
+        
+            if retry_engine == 'concurrent':
+                fiducials, principal_point, scores, intersection_angle, retries, noisify = \
+                    detect_fiducials_with_retries(slices,
+                                                  search_windows,
+                                                  templates,
+                                                  expected_angle     = expected_angle,
+                                                  angle_threshold    = angle_threshold,
+                                                  n_seeds            = n_seeds,
+                                                  seed               = seed,
+                                                  invisible_fiducial = invisible_fiducial,
+                                                  pyramid_scale      = pyramid_scale)
+            else:
+                # QC routine
+                # Re-attempt detection with each fiducial marker noisified in turn, until the 
+                # intersection angle is within orthogonality limits.
+                for noisify in [None, 'left', 'top', 'right', 'bottom']:
+                    if noisify == 'left':
+                        print("Warning: intersection angle at principle point is not within orthogonality limits.")
+                        print('Re-attempting fiducial marker detection.')
+                    if noisify:
+                        print("Processing " + noisify + " fiducial.")
+                        retries = retries + 1
+                    
+                    fiducials, principal_point, scores = detect_fiducials_and_principal_point_in_slices(slices,
+                                                                                                        search_windows, 
+                                                                                                        templates, 
+                                                                                                        noisify=noisify,
+                                                                                                        invisible_fiducial=invisible_fiducial,
+                                                                                                        pyramid_scale=pyramid_scale,
+                                                                                                        return_scores=True,
+                                                                                                        seed=seed)
                     intersection_angle = determine_intersection_angle(fiducials)
-                    print('New intersection angle:',intersection_angle)
-                    if intersection_angle > angle_max or intersection_angle < angle_min:
-                        print("Processing bottom fiducial.")
-                        fiducials, principal_point = detect_fiducials_and_principal_point(windows, 
-                                                                                          templates, 
-                                                                                          img_gray,
-                                                                                          noisify='bottom',
-                                                                                          invisible_fiducial=invisible_fiducial)
-                        intersection_angle = determine_intersection_angle(fiducials)
+                    if noisify:
                         print('New intersection angle:',intersection_angle)
-                    
+                    else:
+                        print('Principal point intersection angle:', intersection_angle)
+                
+                    if not (intersection_angle > angle_max or intersection_angle < angle_min):
+                        break
+            
+            if search == 'prior':
+                if (np.nanmin(scores) >= prior_min_score and 
+                    intersection_angle < angle_max and intersection_angle > angle_min):
+                    break
+                print('Weak fiducial marker match within prior windows. Searching full windows.')
+                retries = 0
+                
     if intersection_angle > angle_max or intersection_angle < angle_min:
         print("Unable to improve result for", file_name)
-        print("Please select fiducial markers manually")
-        if image_file_name:
-            principal_point, intersection_angle, fiducials = pick_fiducials_manually(image_file_name=image_file_name)
+        if manual_fallback:
+            print("Please select fiducial markers manually")
+            if image_file_name:
+                principal_point, intersection_angle, fiducials = pick_fiducials_manually(image_file_name=image_file_name)
+            else:
+                principal_point, intersection_angle, fiducials = pick_fiducials_manually(image_array=img_gray)
+            status  = 'picked_manually'
+            scores  = [np.nan, np.nan, np.nan, np.nan]
+            noisify = None
         else:
-            principal_point, intersection_angle, fiducials = pick_fiducials_manually(image_array=img_gray)
+            print("Queued for manual fiducial marker selection")
+            status = 'needs_manual_pick'
+    
+    details = {'intersection_angle': intersection_angle,
+               'fiducials':          fiducials,
+               'principal_point':    principal_point,
+               'scores':             scores,
+               'retries':            retries,
+               'noisify':            noisify,
+               'search':             search,
+               'status':             status}
+    
+    # the cropped output is only reused if it was written with the same crop and rotation
+    crop_parameters = {'crop_from_pp_dist': crop_from_pp_dist,
+                       'side':              side}
+    cropped_now = False
         
     if intersection_angle < angle_max and intersection_angle > angle_min:
-        cropped = crop_about_principal_point(img_gray, 
-                                             principal_point,
-                                             crop_from_pp_dist = crop_from_pp_dist)
-        img_rot = hsfm.core.rotate_camera(cropped, side=side)
         out = os.path.join(output_directory, file_name+'.tif')
-        cv2.imwrite(out,img_rot)
-        final_output = hsfm.utils.optimize_geotif(out)
-        os.remove(out)
-        os.rename(final_output, out)
+        if cached and os.path.exists(out) and cached.get('crop') == crop_parameters:
+            print(out, 'exists. Skipping.')
+        else:
+            if isinstance(side, type(None)):
+                side = hsfm.core.evaluate_image_frame(img_gray)
+            cropped = crop_about_principal_point(img_gray, 
+                                                 principal_point,
+                                                 crop_from_pp_dist = crop_from_pp_dist)
+            img_rot = hsfm.core.rotate_camera(cropped, side=side)
+            hsfm.io.write_tiled_tif(img_rot, out)
+            details['crop'] = crop_parameters
+            cropped_now = True
+    
+    if cache_key and (not cached or cropped_now) and status in ['detected', 'picked_manually']:
+        cache.put(cache_key, details)
         
         
     if qc == True:
-        hsfm.plot.plot_principal_point_and_fiducial_locations(img_gray,
+        if isinstance(img_gray, str):
+            # a downsampled copy is sufficient for plotting
+            qc_scale = 10
+            qc_image = hsfm.geospatial.downsample_geotif_to_array(img_gray, qc_scale)
+        else:
+            qc_scale = 1
+            qc_image = img_gray
+        hsfm.plot.plot_principal_point_and_fiducial_locations(qc_image,
                                                               fiducials,
                                                               principal_point,
                                                               file_name,
-                                                              output_directory='qc/image_preprocessing/')
+                                                              output_directory='qc/image_preprocessing/',
+                                                              image_scale=qc_scale)
+    
+    if return_details:
+        details['cached'] = bool(cached)
+        return details
 
     return intersection_angle 
 
-def pad_image_frame_slices(slices):
-    
-    left_slice   = slices[0]
-    top_slice    = slices[1]
-    right_slice  = slices[2]
-    bottom_slice = slices[3]
-    
-    left_slice_padded   = hsfm.core.pad_image(left_slice)
-    top_slice_padded    = hsfm.core.pad_image(top_slice)
-    right_slice_padded  = hsfm.core.pad_image(right_slice)
-    bottom_slice_padded = hsfm.core.pad_image(bottom_slice)
-    
-    padded_slices = [left_slice_padded, top_slice_padded, right_slice_padded, bottom_slice_padded]
+def pad_image_frame_slices(slices, reuse_buffers=False):
+    """
+    reuse_buffers = True # Pad into per thread buffers that are reused by the next call
+                         # from the same thread, instead of allocating new arrays.
+    """
+    padded_slices = []
+    for i, image_slice in enumerate(slices):
+        out = None
+        if reuse_buffers:
+            out = reusable_buffer('padded_slice_'+str(i), 
+                                  (image_slice.shape[0]+500, image_slice.shape[1]+500))
+        padded_slices.append(hsfm.core.pad_image(image_slice, out=out))
     
     return padded_slices
 
@@ -773,38 +1065,76 @@ def detect_fiducials_and_principal_point(windows,
                                          templates, 
                                          grayscale_unit8_image_array,
                                          noisify=None,
-                                         invisible_fiducial=None):
+                                         invisible_fiducial=None,
+                                         pyramid_scale=None,
+                                         cache=None):
+    """
+    cache = 'fiducials.sqlite' # Cache results by image content, templates and parameters 
+                               # in a hsfm.io.ResultCache.
+    """
     img_gray = grayscale_unit8_image_array
-
-    window_left   = windows[0]
-    window_top    = windows[1]
-    window_right  = windows[2]
-    window_bottom = windows[3]
-
-    # enhance contrast
+    
+    if cache:
+        if isinstance(cache, str):
+            cache = hsfm.io.ResultCache(cache)
+        parameters = {'windows':            windows,
+                      'noisify':            noisify,
+                      'invisible_fiducial': invisible_fiducial,
+                      'pyramid_scale':      pyramid_scale}
+        cache_key = fiducial_detection_cache_key(img_gray, templates, parameters)
+        cached = cache.get(cache_key)
+        if cached:
+            fiducials = [tuple(i) for i in cached['fiducials']]
+            return fiducials, tuple(cached['principal_point'])
+
+    # enhance contrast and pull out slices according to window
     # img_gray_clahe = hsfm.image.clahe_equalize_image(img_gray)
-    img_gray_clahe = hsfm.image.img_linear_stretch(img_gray)
+    slices = hsfm.core.stretch_image_frame_slices(img_gray, windows)
+    
+    fiducials, principal_point = detect_fiducials_and_principal_point_in_slices(slices,
+                                                                                windows,
+                                                                                templates,
+                                                                                noisify=noisify,
+                                                                                invisible_fiducial=invisible_fiducial,
+                                                                                pyramid_scale=pyramid_scale)
+    if cache:
+        cache.put(cache_key, {'fiducials':       fiducials,
+                              'principal_point': principal_point})
+    return fiducials, principal_point
 
-    # pull out slices according to window
-    slices = hsfm.core.slice_image_frame(img_gray_clahe,windows)
-    
+def detect_fiducials_and_principal_point_in_slices(slices,
+                                                   windows, 
+                                                   templates, 
+                                                   noisify=None,
+                                                   invisible_fiducial=None,
+                                                   pyramid_scale=None,
+                                                   return_scores=False,
+                                                   seed=None):
+    """
+    Same as detect_fiducials_and_principal_point() for contrast enhanced slices 
+    of the image frame, see stretch_image_frame_slices().
+    return_scores = True # Also return the peak correlation score for each fiducial.
+    seed = 0             # Seed for the noise added to the slice selected by noisify.
+    """
     # pad each slice so that the template can be fully moved over a given fiducial marker
-    padded_slices = hsfm.core.pad_image_frame_slices(slices)
+    padded_slices = hsfm.core.pad_image_frame_slices(slices, reuse_buffers=True)
     
     if noisify == 'left':
-        padded_slices[0] = noisify_template(padded_slices[0])
+        padded_slices[0] = noisify_template(padded_slices[0], rng=seed)
     elif noisify == 'top':
-        padded_slices[1] = noisify_template(padded_slices[1])
+        padded_slices[1] = noisify_template(padded_slices[1], rng=seed)
     elif noisify == 'right':
-        padded_slices[2] = noisify_template(padded_slices[2])
+        padded_slices[2] = noisify_template(padded_slices[2], rng=seed)
     elif noisify == 'bottom':
-        padded_slices[3] = noisify_template(padded_slices[3])
+        padded_slices[3] = noisify_template(padded_slices[3], rng=seed)
           
     # detect fiducial markers
-    fiducials = detect_fiducials(padded_slices, 
-                                 windows, 
-                                 templates, 
-                                 invisible_fiducial=invisible_fiducial)
+    fiducials, scores = detect_fiducials(padded_slices, 
+                                         windows, 
+                                         templates, 
+                                         invisible_fiducial=invisible_fiducial,
+                                         pyramid_scale=pyramid_scale,
+                                         return_scores=True)
     
 
     # detect principal point
@@ -813,7 +1143,8 @@ def detect_fiducials_and_principal_point(windows,
                                                 fiducials[2],
                                                 fiducials[3])
                                                 
-                                                
+    if return_scores:
+        return fiducials, principal_point, scores
     return fiducials, principal_point
 
 def determine_intersection_angle(fiducials):
@@ -829,102 +1160,368 @@ def determine_intersection_angle(fiducials):
     
     return np.round(intersection_angle,4)
 
-def pad_image(grayscale_unit8_image_array):
+def pad_image(grayscale_unit8_image_array, out=None):
+    """
+    out = buffer # Preallocated uint8 array of the padded shape to pad into. 
+                 # Only the border is zeroed before the image is copied in.
+    """
     img = grayscale_unit8_image_array
     a=img.shape[0]+500
     b=img.shape[1]+500
-    padded_img = np.zeros([a,b],dtype=np.uint8)
-    padded_img.fill(0)
+    if isinstance(out, type(None)):
+        padded_img = np.zeros([a,b],dtype=np.uint8)
+    else:
+        padded_img = out
+        padded_img[:250,:]  = 0
+        padded_img[-250:,:] = 0
+        padded_img[:,:250]  = 0
+        padded_img[:,-250:] = 0
     padded_img[250:250+img.shape[0],250:250+img.shape[1]] = img
     return padded_img
+
+# per thread buffers, see reusable_buffer()
+_buffers = threading.local()
+
+def reusable_buffer(name, shape, dtype=np.uint8):
+    """
+    Returns an uninitialized array that is kept per thread and reused by later calls 
+    with the same name, shape and dtype, to avoid reallocating large arrays per image.
+    Only one array is kept per name, it is replaced when the shape or dtype changes.
+    """
+    if not hasattr(_buffers, 'arrays'):
+        _buffers.arrays = {}
+    array = _buffers.arrays.get(name)
+    if isinstance(array, type(None)) or array.shape != tuple(shape) or array.dtype != np.dtype(dtype):
+        # drop the old array before allocating its replacement
+        _buffers.arrays.pop(name, None)
+        array = None
+        _buffers.arrays[name] = np.empty(shape, dtype=dtype)
+    return _buffers.arrays[name]
+
+def release_buffers():
+    """
+    Frees the reusable buffers of the calling thread.
+    """
+    if hasattr(_buffers, 'arrays'):
+        _buffers.arrays.clear()
+
+# threads matching the four fiducials, caps the noisified slice buffers held at once
+max_matching_threads = 4
+
+# shared template matching threads, see matching_executor()
+_matching_executor = {'pid': None, 'executor': None}
+
+def matching_executor(max_workers=None):
+    """
+    Returns a thread pool for template matching that persists between calls, with 
+    max_matching_threads threads. A new pool is created after a fork, as threads are 
+    not inherited by child processes. With max_workers a new pool of that size is 
+    returned, which the caller shuts down.
+    """
+    if not isinstance(max_workers, type(None)):
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    if _matching_executor['pid'] != os.getpid():
+        _matching_executor['executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=max_matching_threads)
+        _matching_executor['pid'] = os.getpid()
+    return _matching_executor['executor']
     
 def detect_fiducials(padded_slices, 
                      windows, 
                      templates, 
-                     invisible_fiducial=None):
-
-    left_slice_padded   = padded_slices[0]
-    top_slice_padded    = padded_slices[1]
-    right_slice_padded  = padded_slices[2]
-    bottom_slice_padded = padded_slices[3]
-
-    window_left   = windows[0]
-    window_top    = windows[1]
-    window_right  = windows[2]
-    window_bottom = windows[3]
-
-    left_template   = templates[0]
-    top_template    = templates[1]
-    right_template  = templates[2]
-    bottom_template = templates[3]
-    
-    
-    left_fiducial = get_fiducial(left_slice_padded, 
-                                           left_template, 
-                                           window_left, 
-                                           position = 'left')
-    top_fiducial = get_fiducial(top_slice_padded, 
-                                          top_template, 
-                                          window_top, 
-                                          position = 'top')
-    right_fiducial = get_fiducial(right_slice_padded, 
-                                            right_template, 
-                                            window_right, 
-                                            position = 'right')
-    bottom_fiducial = get_fiducial(bottom_slice_padded, 
-                                             bottom_template, 
-                                             window_bottom, 
-                                             position = 'bottom')
+                     invisible_fiducial=None,
+                     pyramid_scale=None,
+                     return_scores=False):
+    """
+    pyramid_scale = 4 # Coarse-to-fine template matching, see template_match().
+    return_scores = True # Also return the peak correlation score for each fiducial.
+    """
     
-    if invisible_fiducial == 'right':                                 
-        offset = top_fiducial[0] - bottom_fiducial[0]
-        x = (left_fiducial[0]+2*(top_fiducial[0]-left_fiducial[0]))
-        y = left_fiducial[1] + offset
-        right_fiducial = (x, y)
+    positions = ['left', 'top', 'right', 'bottom']
+    
+    fiducials = []
+    scores    = []
+    for padded_slice, window, template, position in zip(padded_slices, windows, templates, positions):
+        fiducial, score = get_fiducial(padded_slice,
+                                       template,
+                                       window,
+                                       position      = position,
+                                       pyramid_scale = pyramid_scale,
+                                       return_score  = True)
+        fiducials.append(fiducial)
+        scores.append(score)
     
-    fiducials = [left_fiducial, top_fiducial, right_fiducial, bottom_fiducial]
+    left_fiducial, top_fiducial, right_fiducial, bottom_fiducial = fiducials
     
+    if invisible_fiducial == 'right':                                 
+        fiducials[2] = infer_right_fiducial(left_fiducial, top_fiducial, bottom_fiducial)
+        scores[2] = np.nan
+    
+    if return_scores:
+        return fiducials, scores
     return fiducials
 
-def get_fiducial(grayscale_unit8_image_array,template_file, window, position = None):
+def estimate_fiducial_windows(fiducials, templates, margin=100):
+    """
+    Estimates tight fiducial search windows from fiducial marker locations detected 
+    in other scans from the same camera, e.g. the first images of a roll.
+    
+    fiducials = [[left, top, right, bottom], ...] # (x, y) per fiducial for each image
+    
+    Windows are centered on the median location and extend by the largest deviation 
+    from it, plus the template size and margin. Returned as [row_start, row_end, col_start, col_end]
+    in the order left, top, right, bottom like determine_fiducial_windows().
+    """
+    fiducials = np.array(fiducials, dtype=float)
+    median    = np.nanmedian(fiducials, axis=0)
+    deviation = np.nanmax(np.abs(fiducials - median), axis=0)
+    
+    windows = []
+    for i, template in enumerate(templates):
+        h, w = template.shape[:2]
+        x, y = median[i]
+        extent_x = int(np.ceil(deviation[i][0])) + w + margin
+        extent_y = int(np.ceil(deviation[i][1])) + h + margin
+        windows.append([max(0, int(y) - extent_y),
+                        int(y) + extent_y,
+                        max(0, int(x) - extent_x),
+                        int(x) + extent_x])
+    return windows
+
+def infer_right_fiducial(left_fiducial, top_fiducial, bottom_fiducial):
+    offset = top_fiducial[0] - bottom_fiducial[0]
+    x = (left_fiducial[0]+2*(top_fiducial[0]-left_fiducial[0]))
+    y = left_fiducial[1] + offset
+    return (x, y)
+
+def detect_fiducials_with_retries(slices,
+                                  windows,
+                                  templates,
+                                  expected_angle     = 90.0,
+                                  angle_threshold    = 0.2,
+                                  n_seeds            = 1,
+                                  seed               = 0,
+                                  invisible_fiducial = None,
+                                  pyramid_scale      = None,
+                                  max_workers        = None):
+    """
+    Concurrent alternative to re-running detection with each fiducial noisified in turn. 
+    
+    The contrast enhanced slices are padded once and all four fiducials are matched in 
+    parallel threads. If the intersection angle is not within expected_angle +/- angle_threshold, 
+    each fiducial is re-matched in a noisified copy of its slice, n_seeds times with 
+    different seeds, and the candidate with the intersection angle closest to 
+    expected_angle is returned. Only the noisified fiducial changes between candidates, 
+    so the other matches are reused.
+    
+    Returns fiducials, principal_point, scores, intersection_angle, retries and 
+    the position of the noisified fiducial of the selected candidate (None for the baseline).
+    """
+    positions = ['left', 'top', 'right', 'bottom']
+    angle_min = expected_angle-angle_threshold
+    angle_max = expected_angle+angle_threshold
+    
+    padded_slices = hsfm.core.pad_image_frame_slices(slices, reuse_buffers=True)
+    
+    # noisified variants are written to per thread buffers, sized for the largest slice
+    scratch_size = max([i.size for i in padded_slices])
+    
+    def match(task):
+        index, rng = task
+        padded_slice = padded_slices[index]
+        if not isinstance(rng, type(None)):
+            noisified = reusable_buffer('noisified_slice', (scratch_size,))
+            noisified = noisified[:padded_slice.size].reshape(padded_slice.shape)
+            mask = reusable_buffer('noisified_mask', (scratch_size,), dtype=bool)
+            mask = mask[:padded_slice.size].reshape(padded_slice.shape)
+            np.copyto(noisified, padded_slice)
+            padded_slice = noisify_template(noisified, 
+                                            rng   = rng, 
+                                            mask  = mask, 
+                                            noise = reusable_buffer('noise', (scratch_size,)))
+        return get_fiducial(padded_slice,
+                            templates[index],
+                            windows[index],
+                            position      = positions[index],
+                            pyramid_scale = pyramid_scale,
+                            return_score  = True)
+    
+    def evaluate(fiducials, scores):
+        fiducials = list(fiducials)
+        scores = list(scores)
+        if invisible_fiducial == 'right':
+            fiducials[2] = infer_right_fiducial(fiducials[0], fiducials[1], fiducials[3])
+            scores[2] = np.nan
+        return fiducials, scores, determine_intersection_angle(fiducials)
+    
+    # threads and their buffers are kept between calls, the padded slices are buffered by the calling thread
+    pool = matching_executor(max_workers)
+    baseline = list(pool.map(match, [(i, None) for i in range(4)]))
+    fiducials, scores, intersection_angle = evaluate([i[0] for i in baseline], 
+                                                     [i[1] for i in baseline])
+    print('Principal point intersection angle:', intersection_angle)
+    
+    candidates = [(fiducials, scores, intersection_angle, None)]
+    retries = 0
+    
+    if intersection_angle > angle_max or intersection_angle < angle_min:
+        print("Warning: intersection angle at principle point is not within orthogonality limits.")
+        print('Re-attempting fiducial marker detection with all fiducials noisified.')
+        indices = [i for i in range(4) if not (invisible_fiducial == 'right' and i == 2)]
+        indices = [i for i in indices for n in range(n_seeds)]
+        # one independent stream per variant, so results do not depend on thread scheduling
+        rngs = np.random.SeedSequence(seed).spawn(len(indices))
+        results = list(pool.map(match, zip(indices, rngs)))
+        retries = len(results)
+        
+        for index, result in zip(indices, results):
+            variant_fiducials = [i[0] for i in baseline]
+            variant_scores    = [i[1] for i in baseline]
+            variant_fiducials[index] = result[0]
+            variant_scores[index]    = result[1]
+            candidates.append(evaluate(variant_fiducials, variant_scores) + (positions[index],))
+    
+    if not isinstance(max_workers, type(None)):
+        pool.shutdown()
+    
+    # the baseline comes first and wins ties
+    fiducials, scores, intersection_angle, noisify = min(candidates, 
+                                                         key=lambda i: abs(i[2] - expected_angle))
+    if noisify:
+        print('Selected candidate with ' + noisify + ' fiducial noisified.')
+        print('New intersection angle:',intersection_angle)
+    
+    principal_point = determine_principal_point(fiducials[0],
+                                                fiducials[1],
+                                                fiducials[2],
+                                                fiducials[3])
+    
+    return fiducials, principal_point, scores, intersection_angle, retries, noisify
+
+def get_fiducial(grayscale_unit8_image_array,
+                 template, 
+                 window, 
+                 position = None,
+                 pyramid_scale = None,
+                 return_score = False):
+    """
+    pyramid_scale = 4 # Coarse-to-fine search, see template_match().
+    return_score = True # Also return the peak correlation score of the match.
+    """
+    if position not in ['left', 'top', 'right', 'bottom']:
+        raise ValueError("position must be 'left', 'top', 'right' or 'bottom', not " + repr(position))
+    
     img_gray = grayscale_unit8_image_array
-    loc,w,h,res = template_match(img_gray,template_file)
+    loc,w,h,res = template_match(img_gray,template,pyramid_scale=pyramid_scale)
     
     if position == 'left':
         x = window[2] + loc[1][0] + w - 250
         y = window[0] + loc[0][0] + int(h/2) - 250
-        return x,y
         
     if position == 'top':
         x = window[2] + loc[1][0] + int(w/2) - 250
-        y = loc[0][0] + h - 250
-        return x,y
+        y = window[0] + loc[0][0] + h - 250
     
     if position == 'right':
         x = window[2] + loc[1][0] - 250
         y = window[0] + loc[0][0] + int(h/2) - 250
-        return x,y
     
     if position == 'bottom':
         x = window[2] + loc[1][0] + int(w/2) - 250
         y = window[0] + loc[0][0] - 250
-        return x,y
+    
+    if return_score:
+        return (x,y), float(res.max())
+    return x,y
         
-def template_match(grayscale_unit8_image_array,template_file):
+def template_match(grayscale_unit8_image_array,template,pyramid_scale=None,refine_min_score=0.6):
+    """
+    template = uint8 array from a FiducialTemplateBank or path to a template file.
+    pyramid_scale = 4 # Find the best match on the image and template downsampled 
+                      # by this factor, then refine at full resolution in a small 
+                      # neighborhood around the candidate.
+    refine_min_score = 0.6 # Search the full resolution image if the refined match 
+                           # scores lower, e.g. for noisified slices.
+    """
     img_gray = grayscale_unit8_image_array
-    template = cv2.imread(template_file)
-    template = cv2.cvtColor(template,cv2.COLOR_BGR2GRAY)
-    template = hsfm.image.img_linear_stretch(template)
-    template = hsfm.core.noisify_template(template)
+    if isinstance(template, str):
+        template = prepare_template(template)
     w, h = template.shape[::-1]
+    
+    if pyramid_scale and pyramid_scale > 1:
+        return pyramid_template_match(img_gray, template, pyramid_scale, refine_min_score=refine_min_score)
+    
     res = cv2.matchTemplate(img_gray,template,cv2.TM_CCOEFF_NORMED)
     loc = np.where(res==res.max())
     return loc,w,h,res
+
+def pyramid_template_match(grayscale_unit8_image_array, template, pyramid_scale=4, refine_min_score=0.6):
+    """
+    Coarse-to-fine version of template_match(). Returns loc in full resolution 
+    coordinates and the correlation surface of the refinement neighborhood.
+    
+    Downsampling averages fine structure, e.g. noise, towards a flat mean, so the coarse 
+    peak can be wrong. If the refined peak scores below refine_min_score the full 
+    resolution image is searched instead.
+    """
+    img_gray = grayscale_unit8_image_array
+    w, h = template.shape[::-1]
+    
+    coarse_w = int(w / pyramid_scale)
+    coarse_h = int(h / pyramid_scale)
+    coarse_img_w = int(img_gray.shape[1] / pyramid_scale)
+    coarse_img_h = int(img_gray.shape[0] / pyramid_scale)
+    
+    if coarse_w < 4 or coarse_h < 4 or coarse_img_w < coarse_w or coarse_img_h < coarse_h:
+        # too small to be matched at this scale
+        return template_match(img_gray, template)
+    
+    img_coarse = cv2.resize(img_gray, (coarse_img_w, coarse_img_h), interpolation=cv2.INTER_AREA)
+    template_coarse = cv2.resize(template, (coarse_w, coarse_h), interpolation=cv2.INTER_AREA)
+    res_coarse = cv2.matchTemplate(img_coarse,template_coarse,cv2.TM_CCOEFF_NORMED)
+    loc_coarse = np.where(res_coarse==res_coarse.max())
+    
+    # candidate upper left corner at full resolution, refined within +/- 2 coarse pixels
+    y = int(loc_coarse[0][0] * pyramid_scale)
+    x = int(loc_coarse[1][0] * pyramid_scale)
+    radius = 2 * int(np.ceil(pyramid_scale))
+    y0 = max(0, y - radius)
+    x0 = max(0, x - radius)
+    y1 = min(img_gray.shape[0] - h, y + radius)
+    x1 = min(img_gray.shape[1] - w, x + radius)
+    
+    neighborhood = img_gray[y0:y1+h, x0:x1+w]
+    res = cv2.matchTemplate(neighborhood,template,cv2.TM_CCOEFF_NORMED)
+    if res.max() < refine_min_score:
+        return template_match(img_gray, template)
+    loc = np.where(res==res.max())
+    loc = (loc[0] + y0, loc[1] + x0)
+    return loc,w,h,res
+    
+def noisify_template(template, rng=None, mask=None, noise=None, chunk_size=2**20):
+    """
+    Replaces bright pixels with random noise, in place.
     
-def noisify_template(template):
-    mask = template > 50
-    rand = np.random.randint(0,256,size=template.shape)
-    template[mask] = rand[mask]
+    rng = 0                # Seed, np.random.SeedSequence or np.random.Generator for reproducible noise.
+    mask = np.empty(...)   # Preallocated bool array shaped like template, used for the mask.
+    noise = np.empty(...)  # Preallocated uint8 array with at least template.size elements. The noise 
+                           # is drawn into it in chunks of chunk_size bytes, which gives the same 
+                           # noise as drawing it at once.
+    """
+    rng = np.random.default_rng(rng)
+    if isinstance(mask, type(None)):
+        mask = template > 50
+    else:
+        np.greater(template, 50, out=mask)
+    # draw noise only for the masked pixels
+    n = int(np.count_nonzero(mask))
+    if isinstance(noise, type(None)):
+        rand = np.frombuffer(rng.bytes(n), dtype=np.uint8)
+    else:
+        rand = noise[:n]
+        for start in range(0, n, chunk_size):
+            chunk = rand[start:start+chunk_size]
+            chunk[:] = np.frombuffer(rng.bytes(chunk.size), dtype=np.uint8)
+    template[mask] = rand
     return template
     
 def determine_principal_point(left_fiducial, top_fiducial, right_fiducial, bottom_fiducial):
@@ -946,10 +1543,10 @@ def crop_about_principal_point(grayscale_unit8_image_array,
     y_T = int(principal_point[1]-crop_from_pp_dist/2)
     y_B = int(principal_point[1]+crop_from_pp_dist/2)
     
-    cropped = img_gray[y_T:y_B, x_L:x_R]
+    # reads only the cropped region if img_gray is an image file name
+    cropped = slice_image_frame(img_gray, [[y_T, y_B, x_L, x_R]])[0]
 
-    cropped = hsfm.image.clahe_equalize_image(cropped)
-    cropped = hsfm.image.img_linear_stretch(cropped)
+    cropped = hsfm.image.clahe_equalize_and_stretch_image(cropped)
 
     return cropped
     
@@ -1192,31 +1789,25 @@ def metadata_transform(metadata_file,
     '''
     Applies pc_align transform to lat, lon, alt positions.
     '''
-    metadata_df = pd.read_csv(metadata_file)
-    df = hsfm.geospatial.df_xyz_coords_to_gdf(metadata_df, z='alt')
-    df = df.to_crs('epsg:4978')
-    hsfm.geospatial.extract_gpd_geometry(df)
-    
-    df_tmp = pd.DataFrame()
-    for index, row in df.iterrows():
-        C = [row.x,row.y,row.z]
-        C_translation, R_transform = hsfm.core.extract_transform(pc_align_transform_file)
-        row.x,row.y,row.z = hsfm.core.apply_position_transform(C, C_translation, R_transform)
-
-        row = row.drop(['geometry'])
-        df_tmp = df_tmp.append(row)
-        
-    transformed_metadata = hsfm.geospatial.df_xyz_coords_to_gdf(df_tmp, 
-                                                                lon='x', 
-                                                                lat= 'y', 
-                                                                z='z',
-                                                                epsg_code='4978')
-
-    transformed_metadata = transformed_metadata.to_crs('epsg:4326')
-    hsfm.geospatial.extract_gpd_geometry(transformed_metadata)
-
-    transformed_metadata[['lon', 'lat','alt']] = transformed_metadata[['x', 'y','z']]
-    transformed_metadata = transformed_metadata.drop(['x', 'y','z', 'geometry'], axis=1)
+    transformed_metadata = pd.read_csv(metadata_file)
+    transform = read_transform(pc_align_transform_file)
+    
+    x, y, z = hsfm.geospatial.transform_coordinates(transformed_metadata['lon'].values,
+                                                    transformed_metadata['lat'].values,
+                                                    transformed_metadata['alt'].values,
+                                                    '4326',
+                                                    '4978')
+    xyz = apply_transform(np.column_stack([x, y, z]), transform)
+    
+    lon, lat, alt = hsfm.geospatial.transform_coordinates(xyz[:, 0],
+                                                          xyz[:, 1],
+                                                          xyz[:, 2],
+                                                          '4978',
+                                                          '4326')
+    transformed_metadata['lon'] = lon
+    transformed_metadata['lat'] = lat
+    transformed_metadata['alt'] = alt
+    
     transformed_metadata = transformed_metadata[['image_file_name', 
                                                  'lon', 
                                                  'lat', 
@@ -1238,23 +1829,36 @@ def metadata_transform(metadata_file,
     
     return transformed_metadata
 
+def read_transform(pc_align_transform_file):
+    """
+    Reads the 4x4 pc_align transform matrix.
+    """
+    return np.loadtxt(pc_align_transform_file).reshape(4, 4)
+
+def apply_transform(xyz, transform):
+    """
+    Applies a 4x4 pc_align transform matrix to an (N, 3) array of positions.
+    """
+    xyz = np.asarray(xyz, dtype=float)
+    return xyz @ transform[:3, :3].T + transform[:3, 3]
+
 def extract_transform(pc_align_transform_file):
-    transform = pd.read_csv(pc_align_transform_file, header=None, delimiter=r"\s+")
-    transform = transform.drop(3)
-    C_translation = list(transform[3].values)
-    transform = transform.drop([3],axis=1)
-    a = list(transform.iloc[0].values)
-    b = list(transform.iloc[1].values)
-    c = list(transform.iloc[2].values)
-    R_transform = [a,b,c]
-    
+    """
+    Returns the translation and rotation of a pc_align transform as lists, see read_transform().
+    """
+    transform = read_transform(pc_align_transform_file)
+    C_translation = list(transform[:3, 3])
+    R_transform   = transform[:3, :3].tolist()
     return C_translation, R_transform
 
 def apply_position_transform(C, C_translation, R_transform):
-    xi = R_transform[0][0]*C[0] + R_transform[0][1]*C[1] + R_transform[0][2]*C[2] + C_translation[0]
-    yi = R_transform[1][0]*C[0] + R_transform[1][1]*C[1] + R_transform[1][2]*C[2] + C_translation[1]
-    zi = R_transform[2][0]*C[0] + R_transform[2][1]*C[1] + R_transform[2][2]*C[2] + C_translation[2]
-
+    """
+    Transforms a single position, see apply_transform() for arrays of positions.
+    """
+    transform = np.eye(4)
+    transform[:3, :3] = R_transform
+    transform[:3, 3]  = C_translation
+    xi, yi, zi = apply_transform([C], transform)[0]
     return(xi,yi,zi)
 
 def compute_point_offsets(metadata_file_1, 
@@ -1290,25 +1894,81 @@ def compute_point_offsets(metadata_file_1,
     
 
 def find_sets(lsts):
-    sets = [set(lst) for lst in lsts if lst]
-    merged = True
-    while merged:
-        merged = False
-        results = []
-        while sets:
-            common, rest = sets[0], sets[1:]
-            sets = []
-            for x in rest:
-                if x.isdisjoint(common):
-                    sets.append(x)
-                else:
-                    merged = True
-                    common |= x
-            results.append(common)
-        sets = results
-    return [sorted(list(s)) for s in sets]
-    
-    
+    """
+    Merges lists (e.g. matched image pairs) that share elements into connected components, 
+    using a disjoint-set forest with path halving and union by size. 
+    Returns sorted components ordered by first occurrence in lsts.
+    """
+    parent = {}
+    size   = {}
+    
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    
+    for lst in lsts:
+        if not len(lst):
+            continue
+        for x in lst:
+            if x not in parent:
+                parent[x] = x
+                size[x]   = 1
+        root = find(lst[0])
+        for x in lst[1:]:
+            other = find(x)
+            if other == root:
+                continue
+            if size[other] > size[root]:
+                root, other = other, root
+            parent[other] = root
+            size[root]   += size[other]
+    
+    components = {}
+    for x in parent:
+        components.setdefault(find(x), []).append(x)
+    return [sorted(component) for component in components.values()]
+    
+    
+    
+def partition_cluster(x, y, max_cluster_size, overlap_m = 0):
+    """
+    Splits a cluster of image centers x, y into spatially compact blocks by recursive 
+    bisection at the median of the longer extent. Each block gets the images within 
+    overlap_m of its core as a shared margin. Cores are split until core and margin fit 
+    in max_cluster_size, or the core alone fills half of it, in which case the margin 
+    images farthest from the core are dropped so that no block exceeds max_cluster_size.
+    Returns a list of positional index arrays.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    
+    def margin(core):
+        # distance of every image to the bounding box of the core
+        dx = np.maximum(np.maximum(x[core].min() - x, x - x[core].max()), 0)
+        dy = np.maximum(np.maximum(y[core].min() - y, y - y[core].max()), 0)
+        distance = np.hypot(dx, dy)
+        distance[core] = np.inf
+        inside = np.where(distance <= overlap_m)[0]
+        return inside[np.argsort(distance[inside], kind='stable')]
+    
+    blocks = []
+    cores  = [np.arange(len(x))]
+    while cores:
+        core    = cores.pop(0)
+        nearest = margin(core)
+        if len(core) + len(nearest) > max_cluster_size and len(core) > max(max_cluster_size // 2, 1):
+            if np.ptp(x[core]) >= np.ptp(y[core]):
+                order = core[np.argsort(x[core], kind='stable')]
+            else:
+                order = core[np.argsort(y[core], kind='stable')]
+            half = len(order) // 2
+            cores[:0] = [np.sort(order[:half]), np.sort(order[half:])]
+            continue
+        nearest = nearest[:max(max_cluster_size - len(core), 0)]
+        blocks.append(np.union1d(core, nearest))
+    return blocks
     
 def determine_image_clusters(image_metadata,
                              image_square_dim               = None,
@@ -1316,7 +1976,6 @@ def determine_image_clusters(image_metadata,
                              focal_length                   = None,
                              image_directory                = None,
                              buffer_m                       = 1200,
-#                              flight_altitude_above_ground_m = 1500,
                              output_directory               = None,
                              image_extension                = '.tif',
                              image_file_name_column         = 'fileName',
@@ -1324,14 +1983,32 @@ def determine_image_clusters(image_metadata,
                              qc                             = True,
                              image_metadata_longitude_column = 'Longitude',
                              image_metadata_latitude_column = 'Latitude',
-                             image_metadata_altitude_column = 'Altitude' 
+                             image_metadata_altitude_column = 'Altitude',
+                             max_cluster_size               = None,
+                             cluster_overlap_m              = None,
+                             staging                        = 'copy',
+                             footprints                     = 'circle',
+                             flight_altitude_above_ground_m = 1500
                              ):
     
     """
     buffer_m = Approximate image footprint diameter in meters.
+    footprints = 'rectangle' # Square footprints of image_square_dim pixels, rotated to the heading 
+                             # towards the next image and scaled by flight_altitude_above_ground_m, 
+                             # see compute_footprints(). image_square_dim defaults to the size of 
+                             # the first image in image_directory. Images that do not overlap any 
+                             # other get growing circular footprints, as with footprints = 'circle'.
     move_images = True # images are moved instead of copied.
+    staging = 'copy', 'hardlink', 'symlink', 'reflink' # how images are placed in cluster_xxx/images, 
+              'manifest-only' # only write cluster_xxx/images.txt listing the image paths.
+    max_cluster_size = 200 # clusters with more images are split into overlapping sub-blocks.
+    cluster_overlap_m = Margin shared by neighbouring sub-blocks. Defaults to buffer_m / 2.
     """
     
+    if move_images and not isinstance(max_cluster_size, type(None)):
+        raise ValueError('move_images can not be combined with max_cluster_size, '
+                         'as sub-blocks share images. Use staging instead.')
+    
     if not isinstance(image_metadata, type(pd.DataFrame())):
         df = pd.read_csv(image_metadata)
     else:
@@ -1347,74 +2024,78 @@ def determine_image_clusters(image_metadata,
     epsg_code = hsfm.geospatial.lon_lat_to_utm_epsg_code(lon, lat)
     gdf = gdf.to_crs('epsg:' +epsg_code)
     
-    # approximate square altitude dependant footprint
-    # this does not work very well for clustering due to variable
-    # flight altitudes and distance above ground.
-#     if isinstance(image_square_dim, type(None)) and isinstance(image_directory, type(str())):
-#         img = glob.glob(os.path.join(image_directory,'*.tif'))[0]
-#         img = cv2.imread(img, cv2.IMREAD_GRAYSCALE)
-#         image_square_dim = img.shape[0]
-#     gdf['polygon'] = hsfm.core.compute_square_footprint(gdf,
-#                                                     image_square_dim,
-#                                                     pixel_pitch,
-#                                                     focal_length,
-#                                                     flight_altitude_above_ground_m)
-    
-#     return gdf
-    
-    # approximate circular image foot print
-    print('Estimated footprint diameter:', buffer_m)
-    radius_m = buffer_m/2
-    gdf['polygon'] = gdf.geometry.buffer(radius_m)
-
-    footprints = []
-    for i in gdf.polygon.values:
-        d = gpd.GeoDataFrame(gpd.GeoSeries(i),
-                             columns=['geometry'],
-                             crs='epsg:' +epsg_code) 
-        footprints.append(d)
+    if footprints == 'rectangle':
+        # approximate square altitude dependant footprint
+        # this does not work very well for clustering with variable
+        # flight altitudes and distance above ground.
+        if isinstance(image_square_dim, type(None)) and isinstance(image_directory, type(str())):
+            img = sorted(glob.glob(os.path.join(image_directory,'*'+image_extension)))[0]
+            image_square_dim = hsfm.io.get_image_shape(img)[0]
+        if isinstance(image_square_dim, type(None)):
+            raise ValueError("footprints = 'rectangle' requires image_square_dim or image_directory")
+        
+        # headings towards the next image by file name, see hsfm.batch.calculate_heading_from_metadata()
+        order = np.argsort(df[image_file_name_column].values, kind='stable')
+        sorted_headings = hsfm.geospatial.calculate_headings(df[image_metadata_longitude_column].values[order],
+                                                             df[image_metadata_latitude_column].values[order])
+        sorted_headings = hsfm.geospatial.carry_heading_forward(sorted_headings, 
+                                                                np.arange(len(order)) == len(order) - 1)
+        headings = np.empty(len(order))
+        # a single image has no heading
+        headings[order] = np.nan_to_num(sorted_headings)
+        
+        gdf['polygon'] = compute_footprints(gdf.geometry.x.values,
+                                            gdf.geometry.y.values,
+                                            flight_altitude_above_ground_m,
+                                            focal_length,
+                                            pixel_pitch,
+                                            image_square_dim,
+                                            heading = headings)
+        # circumscribed circle, bounds the spatial index queries
+        GSD = compute_GSD(flight_altitude_above_ground_m, pixel_pitch, focal_length, verbose=False)
+        radius_m = GSD * image_square_dim / np.sqrt(2)
+        print('Estimated footprint width:', round(GSD * image_square_dim))
+    else:
+        # approximate circular image foot print
+        print('Estimated footprint diameter:', buffer_m)
+        radius_m = buffer_m/2
+        gdf['polygon'] = gdf.geometry.buffer(radius_m)
+    gdf['radius'] = radius_m
+    circles = footprints != 'rectangle'
     
     file_names = list(df[image_file_name_column].values)
-    footprints = np.array(list(zip(file_names, footprints)),dtype=object)
     
     # find intersecting image pairs
     threshold = 200000
-    matches = []
-    areas = []
-    for a, b in itertools.combinations(footprints, 2):
-        intersection = gpd.overlay(a[1], b[1], how='intersection') 
-        if len(intersection) > 0 and intersection.area[0] > threshold:
-            areas.append(intersection.area[0])
-            matches.append((a[0], b[0]))
+    matches, areas = find_overlapping_footprints(gdf, file_names, threshold, circles=circles)
             
     matched_files   = list(set(np.array(matches).flatten()))
     unmatched_files = hsfm.core.diff_lists(matched_files, file_names)
+    
+    # footprint centers don't move, so their spatial index is built once and reused
+    points    = gpd.GeoSeries(gdf.geometry.values)
+    positions = {file_name: k for k, file_name in enumerate(file_names)}
 
     # expand footprint radius for single images until the belong to a set
     while len(unmatched_files) > 0 and radius_m < 10000:
         print('Images not part of a cluster:', *unmatched_files, sep = "\n")
         radius_m = radius_m + 500
         print('Increasing estimated footprint diameter to:', int(2*radius_m))
-        gdf.loc[gdf[image_file_name_column].isin(unmatched_files),'polygon'] = \
-        gdf.loc[gdf[image_file_name_column].isin(unmatched_files),'geometry'].buffer(radius_m)
-
-        footprints = []
-        for i in gdf.polygon.values:
-            d = gpd.GeoDataFrame(gpd.GeoSeries(i),
-                                 columns=['geometry'],
-                                 crs='epsg:' +epsg_code) 
-            footprints.append(d)
-        file_names = list(df[image_file_name_column].values)
-        footprints = np.array(list(zip(file_names, footprints)),dtype=object)
-
-        matches = []
-        areas = []
-
-        for a, b in itertools.combinations(footprints, 2):
-            intersection = gpd.overlay(a[1], b[1], how='intersection') 
-            if len(intersection) > 0 and intersection.area[0] > threshold:
-                areas.append(intersection.area[0])
-                matches.append((a[0], b[0]))
+        unmatched = gdf[image_file_name_column].isin(unmatched_files).values
+        gdf.loc[unmatched,'polygon'] = gdf.loc[unmatched,'geometry'].buffer(radius_m)
+        gdf.loc[unmatched,'radius']  = radius_m
+        
+        # pairs among matched images are unchanged, only re-test the unmatched ones
+        new_matches, new_areas = find_overlapping_footprints(gdf, 
+                                                             file_names, 
+                                                             threshold,
+                                                             subset  = np.where(unmatched)[0],
+                                                             points  = points,
+                                                             circles = circles)
+        pairs   = sorted(zip(matches + new_matches, areas + new_areas),
+                         key = lambda pair: (positions[pair[0][0]], positions[pair[0][1]]))
+        matches = [pair[0] for pair in pairs]
+        areas   = [pair[1] for pair in pairs]
 
         matched_files   = list(set(np.array(matches).flatten()))
         unmatched_files = hsfm.core.diff_lists(matched_files, file_names)
@@ -1427,6 +2108,30 @@ def determine_image_clusters(image_metadata,
 
     clusters = hsfm.core.find_sets(matches)
     
+    # split large clusters into sub-blocks named like cluster_003_00
+    cluster_names = ['cluster_' + str(i).zfill(3) for i in range(len(clusters))]
+    if not isinstance(max_cluster_size, type(None)):
+        if isinstance(cluster_overlap_m, type(None)):
+            cluster_overlap_m = buffer_m / 2
+        blocks      = []
+        block_names = []
+        for name, cluster in zip(cluster_names, clusters):
+            if len(cluster) <= max_cluster_size:
+                blocks.append(cluster)
+                block_names.append(name)
+                continue
+            c = gdf[gdf[image_file_name_column].isin(cluster)]
+            sub_blocks = hsfm.core.partition_cluster(c.geometry.x.values,
+                                                     c.geometry.y.values,
+                                                     max_cluster_size,
+                                                     overlap_m = cluster_overlap_m)
+            print('Splitting', name, 'with', len(cluster), 'images into', len(sub_blocks), 'blocks')
+            for j, sub_block in enumerate(sub_blocks):
+                blocks.append(sorted(c[image_file_name_column].values[sub_block]))
+                block_names.append(name + '_' + str(j).zfill(2))
+        clusters      = blocks
+        cluster_names = block_names
+    
     if qc:
         gdf['geometry'] = gdf['polygon']
         fig, ax = plt.subplots(1,figsize=(10,10))
@@ -1437,7 +2142,7 @@ def determine_image_clusters(image_metadata,
             # label cluster
             p = gpd.GeoSeries(shapely.ops.cascaded_union(c['polygon']))
             p = (p.representative_point().x[0], p.representative_point().y[0])
-            ax.annotate(str(i).zfill(3),
+            ax.annotate(cluster_names[i].replace('cluster_', ''),
                         xy=p,
                         horizontalalignment='center',
                         size=15)
@@ -1457,14 +2162,14 @@ def determine_image_clusters(image_metadata,
         
     if isinstance(output_directory, type(str())):
         for i,v in enumerate(clusters):
-            outdir = os.path.join(output_directory, 'cluster_' + str(i).zfill(3))
+            outdir = os.path.join(output_directory, cluster_names[i])
             p = pathlib.Path(outdir)
             p.mkdir(parents=True, exist_ok=True)
 
             tmp = gdf[gdf[image_file_name_column].isin(v)].copy()
             hsfm.core.prepare_metashape_metadata(tmp,
                                                  output_directory=outdir,
-#                                                  flight_altitude_above_ground_m = flight_altitude_above_ground_m,
+                                                 flight_altitude_above_ground_m = flight_altitude_above_ground_m,
                                                  focal_length=focal_length,
                                                  pixel_pitch= pixel_pitch,
                                                  image_file_name_column = image_file_name_column,
@@ -1479,6 +2184,10 @@ def determine_image_clusters(image_metadata,
                 for i in tmp[image_file_name_column].values:
                     images.append(os.path.join(image_directory,i+'.tif'))
 
+                if staging == 'manifest-only' and not move_images:
+                    hsfm.io.write_image_manifest(images, os.path.join(outdir,'images.txt'))
+                    continue
+                
                 p = pathlib.Path(os.path.join(outdir,'images'))
                 p.mkdir(parents=True, exist_ok=True)
 
@@ -1486,59 +2195,131 @@ def determine_image_clusters(image_metadata,
                     if move_images:
                         shutil.move(i,os.path.join(outdir,'images'))
                     else:
-                        shutil.copy2(i,os.path.join(outdir,'images'))
+                        hsfm.io.stage_file(i,
+                                           os.path.join(outdir,'images',os.path.basename(i)),
+                                           strategy = staging)
+
+def find_overlapping_footprints(gdf, 
+                                file_names, 
+                                threshold,
+                                subset         = None,
+                                points         = None,
+                                polygon_column = 'polygon',
+                                radius_column  = 'radius',
+                                resolution     = 16,
+                                circles        = True):
+    """
+    Returns image pairs whose circular footprints intersect by more than threshold (m^2), 
+    ordered like itertools.combinations(file_names, 2), and their intersection areas.
+    
+    Candidate pairs are found with a spatial index and their areas computed in closed form 
+    from center distance and radii. The footprint polygons from buffer(radius, resolution) 
+    lie between the circle and the circle shrunk by the polygon sagitta, so only pairs 
+    whose area bounds straddle the threshold are intersected as polygons.
+    
+    With subset (positional indices) only pairs involving those images are tested, using 
+    the spatial index of the footprint centers in points, which can be reused across calls.
+    
+    circles = False # Footprints are any polygons within radius of their center, e.g. from 
+                    # compute_footprints(). All candidate pairs are intersected as polygons.
+    """
+    polygons = gpd.GeoSeries(gdf[polygon_column].values)
+    
+    x = gdf.geometry.x.values
+    y = gdf.geometry.y.values
+    r = gdf[radius_column].values
+    
+    if isinstance(subset, type(None)):
+        i, j = hsfm.geospatial.sindex_query_pairs(polygons)
+    else:
+        if isinstance(points, type(None)):
+            points = gpd.GeoSeries(gdf.geometry.values)
+        subset = np.asarray(subset, dtype=int)
+        i, j = hsfm.geospatial.sindex_query_neighbors(points, 
+                                                      subset, 
+                                                      r[subset] + r.max())
+    if circles:
+        distance = np.hypot(x[i] - x[j], y[i] - y[j])
+        areas = hsfm.geospatial.circle_intersection_area(distance, r[i], r[j])
+        
+        sagitta = 1 - np.cos(np.pi / (4 * resolution))
+        lower_bounds = hsfm.geospatial.circle_intersection_area(distance, 
+                                                                r[i] * (1 - sagitta), 
+                                                                r[j] * (1 - sagitta))
+        close = (areas > threshold) & (lower_bounds <= threshold)
+    else:
+        areas = np.zeros(len(i))
+        close = np.ones(len(i), dtype=bool)
+    for k in np.where(close)[0]:
+        areas[k] = polygons.iloc[i[k]].intersection(polygons.iloc[j[k]]).area
+    
+    mask = areas > threshold
+    matches = [(file_names[a], file_names[b]) for a, b in zip(i[mask], j[mask])]
+    return matches, list(areas[mask])
 
 def compute_square_footprint(gdf,
                              image_square_dim,
                              pixel_pitch,
                              focal_length,
-                             flight_altitude_above_ground_m):
+                             flight_altitude_above_ground_m,
+                             heading = None):
+    """
+    Square footprint polygons in UTM for the Longitude and Latitude columns of gdf, 
+    see compute_footprints(). gdf is not modified.
     
+    heading = None # Degrees clockwise from north, defaults to the heading column of gdf if present, 
+                   # e.g. from hsfm.batch.calculate_heading_from_metadata(), else north.
+    """
     lons = gdf['Longitude'].values
     lats = gdf['Latitude'].values
-    epsg_code = hsfm.geospatial.lon_lat_to_utm_epsg_code(lons[0], lats[0])
-    
-    gdf['elev']             = hsfm.geospatial.USGS_elevation_function(lats, lons)
-    gdf['alt']              = gdf['elev'] + flight_altitude_above_ground_m
-#     gdf['alt']              = round(gdf['alt'].max())
-    gdf['alt_above_ground'] = gdf['alt'] - gdf['elev']
     
-    gdf['GSD'] = gdf['alt_above_ground'].apply(hsfm.core.compute_GSD, 
-                                               args=(pixel_pitch, 
-                                                     focal_length,
-                                                     False))
-    
-    gdf['lon_utm'], gdf['lat_utm'] = utm.from_latlon(lats,lons)[:2]
+    if isinstance(heading, type(None)):
+        if 'heading' in gdf.columns:
+            heading = gdf['heading'].values
+        else:
+            heading = 0
+    
+    x, y = utm.from_latlon(lats,lons)[:2]
+    
+    # the flight altitude is given above ground, so the ground elevation is not needed
+    return compute_footprints(x,
+                              y,
+                              flight_altitude_above_ground_m,
+                              focal_length,
+                              pixel_pitch,
+                              image_square_dim,
+                              heading = heading)
+
+def compute_footprints(x, 
+                       y, 
+                       alt_above_ground, 
+                       focal_length, 
+                       pixel_pitch, 
+                       image_width_px,
+                       image_height_px = None,
+                       heading         = 0):
+    """
+    Rectangular image footprint polygons for arrays of camera centers x, y (e.g. UTM), 
+    altitudes above ground (m) and headings (degrees clockwise from north). 
+    The footprint width lies along the heading, as for hsfm.trig.calculate_corner.
     
-    gdf['footprint_square_dim'] = gdf['GSD'] * image_square_dim
+    image_height_px = None # square images.
+    """
+    if isinstance(image_height_px, type(None)):
+        image_height_px = image_width_px
     
-    gdf['ULLON'] = gdf['lon_utm'] - gdf['footprint_square_dim'] /2
-    gdf['ULLAT'] = gdf['lat_utm'] + gdf['footprint_square_dim'] /2
-    gdf['UL']    = list(zip(gdf['ULLON'].values, gdf['ULLAT'].values))
-
-    gdf['URLON'] = gdf['lon_utm'] + gdf['footprint_square_dim'] /2
-    gdf['URLAT'] = gdf['lat_utm'] + gdf['footprint_square_dim'] /2
-    gdf['UR']    = list(zip(gdf['URLON'].values, gdf['URLAT'].values))
-
-    gdf['LRLON'] = gdf['lon_utm'] + gdf['footprint_square_dim'] /2
-    gdf['LRLAT'] = gdf['lat_utm'] - gdf['footprint_square_dim'] /2
-    gdf['LR']    = list(zip(gdf['LRLON'].values, gdf['LRLAT'].values))
-
-    gdf['LLLON'] = gdf['lon_utm'] - gdf['footprint_square_dim'] /2
-    gdf['LLLAT'] = gdf['lat_utm'] - gdf['footprint_square_dim'] /2
-    gdf['LL']    = list(zip(gdf['LLLON'].values, gdf['LLLAT'].values))
+    GSD = compute_GSD(np.asarray(alt_above_ground, dtype=float), pixel_pitch, focal_length, verbose=False)
+    corners = hsfm.trig.rotate_corners(x,
+                                       y,
+                                       GSD * image_width_px / 2,
+                                       GSD * image_height_px / 2,
+                                       heading)
     
-    footprints = []
-    for i in range(len(gdf)):
-        vertices = (gdf.iloc[i]['UL'], 
-                    gdf.iloc[i]['UR'], 
-                    gdf.iloc[i]['LR'], 
-                    gdf.iloc[i]['LL'])
-    
-        polygon = shapely.geometry.Polygon(vertices)
-        footprints.append(polygon)
-        
-    return footprints
+    try:
+        # shapely >= 2.0
+        return list(shapely.polygons(corners))
+    except AttributeError:
+        return [shapely.geometry.Polygon(vertices) for vertices in corners]
                         
 def compute_GSD(alt_above_ground, pixel_pitch, focal_length, verbose=True):
     IFOV = 2*np.arctan((pixel_pitch/2)/focal_length)
@@ -1,5 +1,6 @@
 import cartopy.crs as ccrs
 import contextily as ctx
+import functools
 import geopandas as gpd
 import geoviews as gv
 from geoviews import opts
@@ -63,6 +64,24 @@ def df_xyz_coords_to_gdf(df,
     
     return gdf
     
+@functools.lru_cache(maxsize=None)
+def get_transformer(source_epsg_code, target_epsg_code):
+    """
+    Cached pyproj Transformer with x, y in lon, lat order for geographic systems.
+    """
+    return pyproj.Transformer.from_crs('epsg:'+str(source_epsg_code), 
+                                       'epsg:'+str(target_epsg_code), 
+                                       always_xy=True)
+
+def transform_coordinates(x, y, z, source_epsg_code, target_epsg_code):
+    """
+    Transforms coordinate arrays, e.g. lon, lat, alt from epsg 4326 to ECEF x, y, z in epsg 4978.
+    """
+    transformer = get_transformer(str(source_epsg_code), str(target_epsg_code))
+    return transformer.transform(np.asarray(x, dtype=float), 
+                                 np.asarray(y, dtype=float), 
+                                 np.asarray(z, dtype=float))
+    
 def df_xy_coords_to_gdf(df, 
                          lon='lon',
                          lat='lat',
@@ -169,6 +188,36 @@ def calculate_heading(point1_lon, point1_lat, point2_lon, point2_lat):
 
     return final_heading
 
+def calculate_headings(lons, lats):
+    """
+    Calculates the bearing from each point to the next, vectorized.
+    The last point has no successor and gets NaN, see carry_heading_forward().
+    """
+    lons = np.radians(np.asarray(lons, dtype=float))
+    lats = np.radians(np.asarray(lats, dtype=float))
+    
+    lat1 = lats[:-1]
+    lat2 = lats[1:]
+    delta_x = lons[1:] - lons[:-1]
+    
+    x = np.sin(delta_x) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(delta_x)
+    
+    headings = (np.degrees(np.arctan2(x, y)) + 360) % 360
+    return np.append(headings, np.nan)[:len(lons)]
+
+def carry_heading_forward(headings, line_ends):
+    """
+    Replaces the headings at line_ends (boolean mask), e.g. the last image of a flight line 
+    whose bearing points to the next line, with the preceding heading.
+    """
+    headings  = np.array(headings, dtype=float)
+    line_ends = np.array(line_ends, dtype=bool)
+    ends = np.where(line_ends)[0]
+    ends = ends[ends > 0]
+    headings[ends] = headings[ends - 1]
+    return headings
+
 def rescale_geotif_to_file(geotif_file_name, scale_factor):
     
     # TODO
@@ -450,4 +499,78 @@ def USGS_elevation_function(lats_list, lons_list):
                 print('Waiting on 200 response from USGS Elevation Point Service...')
                 time.sleep(3)
                 c = c+1
-    return elevations
\ No newline at end of file
+    return elevations
+
+
+def sindex_query_pairs(geoseries, predicate='intersects'):
+    """
+    Returns positional index arrays (i, j), i < j, of all geometry pairs in geoseries 
+    that satisfy predicate, found with the spatial index instead of testing every pair.
+    """
+    geoseries = gpd.GeoSeries(geoseries).reset_index(drop=True)
+    sindex = geoseries.sindex
+    try:
+        # bulk query in geopandas >= 0.12
+        left, right = sindex.query(geoseries.values, predicate=predicate)
+    except (TypeError, ValueError, AttributeError):
+        left, right = sindex.query_bulk(geoseries.values, predicate=predicate)
+    left  = np.asarray(left)
+    right = np.asarray(right)
+    
+    mask  = left < right
+    left  = left[mask]
+    right = right[mask]
+    
+    order = np.lexsort((right, left))
+    return left[order], right[order]
+
+def sindex_query_neighbors(points, indices, distances):
+    """
+    Returns positional index arrays (i, j), i < j, of all pairs between the points at 
+    indices and any point in points closer than the corresponding distances. 
+    
+    Querying the spatial index of points (which geopandas caches on the GeoSeries) only 
+    for the given indices keeps the cost proportional to their number.
+    """
+    indices   = np.asarray(indices, dtype=int)
+    distances = np.broadcast_to(np.asarray(distances, dtype=float), indices.shape)
+    if indices.size == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    
+    sindex = points.sindex
+    # pad the buffered query circles so their polygon approximation contains the circle
+    queries = points.iloc[indices].buffer(distances * 1.01).values
+    try:
+        left, right = sindex.query(queries, predicate='intersects')
+    except (TypeError, ValueError, AttributeError):
+        left, right = sindex.query_bulk(queries, predicate='intersects')
+    left  = indices[np.asarray(left)]
+    right = np.asarray(right)
+    
+    mask  = left != right
+    i     = np.minimum(left, right)[mask]
+    j     = np.maximum(left, right)[mask]
+    
+    pairs = np.unique(np.stack([i, j], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+def circle_intersection_area(distance, radius_a, radius_b):
+    """
+    Exact intersection area of circles with center distance and radii, vectorized.
+    """
+    d, r1, r2 = np.broadcast_arrays(np.asarray(distance, dtype=float),
+                                    np.asarray(radius_a, dtype=float),
+                                    np.asarray(radius_b, dtype=float))
+    area = np.zeros(d.shape)
+    
+    contained = d <= np.abs(r1 - r2)
+    area[contained] = np.pi * np.minimum(r1, r2)[contained]**2
+    
+    partial = ~contained & (d < r1 + r2)
+    d, r1, r2 = d[partial], r1[partial], r2[partial]
+    alpha = np.arccos(np.clip((d**2 + r1**2 - r2**2) / (2 * d * r1), -1, 1))
+    beta  = np.arccos(np.clip((d**2 + r2**2 - r1**2) / (2 * d * r2), -1, 1))
+    kite  = np.sqrt(np.clip((-d + r1 + r2) * (d + r1 - r2) * (d - r1 + r2) * (d + r1 + r2), 0, None))
+    area[partial] = r1**2 * alpha + r2**2 * beta - 0.5 * kite
+    
+    return area
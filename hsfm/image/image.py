@@ -18,16 +18,98 @@ def clahe_equalize_image(img_gray,
     img_gray_clahe = clahe.apply(img_gray)
     return img_gray_clahe
     
+def clahe_equalize_and_stretch_image(img_gray,
+                                     clipLimit = 2.0,
+                                     tileGridSize = (8,8),
+                                     min_max = (0.1, 99.9)):
+    """
+    Same as clahe_equalize_image() followed by img_linear_stretch(), but for uint8 
+    the stretch is applied in place to the equalized image, so only one new 
+    full size array is allocated.
+    """
+    img_gray_clahe = clahe_equalize_image(img_gray, 
+                                          clipLimit = clipLimit, 
+                                          tileGridSize = tileGridSize)
+    if img_gray_clahe.dtype != np.uint8:
+        return img_linear_stretch(img_gray_clahe, min_max = min_max)
+    
+    in_range = image_percentiles(img_gray_clahe, min_max)
+    lut = stretch_lookup_table(in_range)
+    cv2.LUT(img_gray_clahe, lut, dst=img_gray_clahe)
+    return img_gray_clahe
+    
 def img_linear_stretch(img_gray,
-                       min_max = (0.1, 99.9)):
-    p_min, p_max = np.percentile(img_gray, min_max)
+                       min_max = (0.1, 99.9),
+                       in_range = None):
+    """
+    in_range = (p_min, p_max) # Stretch with precomputed percentiles, e.g. of the full
+                              # image when only a slice of it is passed in.
+    
+    uint8 images are stretched with a lookup table and their percentiles are computed 
+    from a histogram, which gives the same result without sorting or float copies.
+    """
+    if isinstance(in_range, type(None)):
+        in_range = image_percentiles(img_gray, min_max)
+    p_min, p_max = in_range
+    if img_gray.dtype == np.uint8:
+        return cv2.LUT(img_gray, stretch_lookup_table((p_min, p_max)))
     img_rescale = exposure.rescale_intensity(img_gray, in_range=(p_min, p_max))
     return img_rescale
     
 def img_linear_stretch_full(img_gray):
-    p_min, p_max = np.percentile(img_gray, (20, 80))
-    img_rescale = exposure.rescale_intensity(img_gray, in_range=(p_min, p_max))
-    return img_rescale
+    return img_linear_stretch(img_gray, min_max = (20, 80))
+
+def stretch_lookup_table(in_range):
+    """
+    Lookup table that maps each uint8 value the same way as exposure.rescale_intensity().
+    """
+    # rescale_intensity is applied per pixel, so applying it to all 256 values is exact
+    values = np.arange(256, dtype=np.uint8)
+    return exposure.rescale_intensity(values, in_range=tuple(in_range))
+
+def image_histogram(img_gray, chunk_pixels=2**24):
+    """
+    Returns the exact 256 bin histogram of a uint8 image, counted with integers. 
+    Rows are counted in chunks of about chunk_pixels, which bounds the intp copy 
+    that np.bincount makes.
+    """
+    img_gray = np.asarray(img_gray)
+    if img_gray.ndim < 2:
+        return np.bincount(img_gray.ravel(), minlength=256).astype(np.int64)
+    
+    histogram = np.zeros(256, dtype=np.int64)
+    row_pixels = max(int(np.prod(img_gray.shape[1:])), 1)
+    rows = max(chunk_pixels // row_pixels, 1)
+    for row in range(0, img_gray.shape[0], rows):
+        histogram += np.bincount(img_gray[row:row+rows].ravel(), minlength=256)
+    return histogram
+
+def image_percentiles(img_gray, percentiles):
+    """
+    Same as np.percentile(), computed from the histogram for uint8 images.
+    """
+    if img_gray.dtype == np.uint8:
+        return percentiles_from_histogram(image_histogram(img_gray), percentiles)
+    return np.percentile(img_gray, percentiles)
+
+def percentiles_from_histogram(histogram, percentiles):
+    """
+    Returns the same values as np.percentile() for integer image data, e.g. uint8, 
+    given its histogram with one bin per integer value.
+    """
+    cdf = np.cumsum(histogram)
+    n = cdf[-1]
+    
+    # fractional rank of each percentile, interpolated linearly like np.percentile()
+    positions = np.asarray(percentiles, dtype=float) / 100 * (n - 1)
+    lower = np.floor(positions)
+    upper = np.minimum(lower + 1, n - 1)
+    
+    # value of the k-th smallest pixel is the first bin whose cdf exceeds k
+    lower_values = np.searchsorted(cdf, lower, side='right')
+    upper_values = np.searchsorted(cdf, upper, side='right')
+    
+    return lower_values + (upper_values - lower_values) * (positions - lower)
 
 '''
 ####
@@ -1,6 +1,18 @@
 import os
 import glob
+import json
+import time
 import shutil
+import sqlite3
+import tempfile
+import hashlib
+import threading
+import contextlib
+import requests
+import cv2
+import numpy as np
+from osgeo import gdal
+from osgeo import gdal_array
 
 """
 Basic io functions.
@@ -110,4 +122,530 @@ def batch_rename_files(source_file_path,
 def retrieve_match(pattern, file_list):
     for i in file_list:
         if pattern in i:
-            return i
\ No newline at end of file
+            return i
+
+
+def get_image_shape(image_file_name):
+    ds = gdal.Open(image_file_name)
+    return ds.RasterYSize, ds.RasterXSize
+
+def read_image_windows(image_file_name, windows):
+    """
+    Reads windows given as [row_start, row_end, col_start, col_end] from the first band
+    of an image on disk, without loading the full image into memory.
+    Windows are clipped to the image extent.
+    """
+    ds = gdal.Open(image_file_name)
+    band = ds.GetRasterBand(1)
+    
+    arrays = []
+    for window in windows:
+        row_start = int(min(max(window[0], 0), ds.RasterYSize))
+        row_end   = int(min(max(window[1], row_start), ds.RasterYSize))
+        col_start = int(min(max(window[2], 0), ds.RasterXSize))
+        col_end   = int(min(max(window[3], col_start), ds.RasterXSize))
+        
+        array = band.ReadAsArray(col_start, 
+                                 row_start, 
+                                 col_end - col_start, 
+                                 row_end - row_start)
+        arrays.append(array)
+    return arrays
+
+def image_histogram(image_file_name):
+    """
+    Returns the 256 bin histogram of an 8-bit image on disk. 
+    GDAL computes it block by block, so the image is never fully loaded into memory.
+    """
+    ds = gdal.Open(image_file_name)
+    band = ds.GetRasterBand(1)
+    histogram = band.GetHistogram(-0.5, 255.5, 256, 0, 0)
+    return np.array(histogram, dtype=np.int64)
+
+def write_tiled_tif(array, 
+                    output_file_name, 
+                    compress   = 'LZW', 
+                    overviews  = None, 
+                    cog        = False,
+                    block_size = 256,
+                    bgr        = True):
+    """
+    Writes an image array to a tiled, compressed GeoTIFF in one pass from memory.
+    Replaces writing with cv2.imwrite and rewriting with hsfm.utils.optimize_geotif.
+    
+    array = 2D array, or 3D array with bands last
+    compress = 'ZSTD'       # Any GDAL GTiff compression, e.g. 'LZW', 'DEFLATE', 'ZSTD', 'NONE'.
+    overviews = [2,4,8,16]  # Internal overview levels.
+    cog = True              # Write a Cloud Optimized GeoTIFF. Overviews are generated 
+                            # automatically unless overviews are given.
+    bgr = False             # 3 and 4 band arrays are in RGB(A) order. By default they are 
+                            # taken to be BGR(A) as read by cv2, and written as RGB(A) like cv2.imwrite.
+    """
+    if array.ndim == 3:
+        if bgr and array.shape[-1] == 3:
+            array = cv2.cvtColor(array, cv2.COLOR_BGR2RGB)
+        elif bgr and array.shape[-1] == 4:
+            array = cv2.cvtColor(array, cv2.COLOR_BGRA2RGBA)
+        array = np.moveaxis(array, -1, 0)
+    mem = gdal_array.OpenArray(np.ascontiguousarray(array))
+    
+    if overviews:
+        mem.BuildOverviews('AVERAGE', list(overviews))
+    
+    if cog:
+        driver = gdal.GetDriverByName('COG')
+        options = ['COMPRESS='+compress,
+                   'BIGTIFF=IF_SAFER',
+                   'BLOCKSIZE='+str(block_size)]
+        if overviews:
+            options.append('OVERVIEWS=FORCE_USE_EXISTING')
+    else:
+        driver = gdal.GetDriverByName('GTiff')
+        options = ['TILED=YES',
+                   'COMPRESS='+compress,
+                   'BIGTIFF=IF_SAFER',
+                   'BLOCKXSIZE='+str(block_size),
+                   'BLOCKYSIZE='+str(block_size)]
+        if overviews:
+            options.append('COPY_SRC_OVERVIEWS=YES')
+    
+    ds = driver.CreateCopy(output_file_name, mem, options=options)
+    if ds is None:
+        raise RuntimeError('Unable to write ' + output_file_name)
+    ds.FlushCache()
+    ds = None
+    mem = None
+    
+    return output_file_name
+
+def hash_file(file_name, chunk_size=2**23, algorithm='blake2b'):
+    """
+    Returns a hash of the file content, blake2b by default.
+    algorithm = 'sha256' # Any hashlib algorithm.
+    """
+    if algorithm == 'blake2b':
+        h = hashlib.blake2b(digest_size=16)
+    else:
+        h = hashlib.new(algorithm)
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hash_array(array):
+    """
+    Returns a blake2b hash of the array content, shape and dtype.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(array.shape).encode())
+    h.update(str(array.dtype).encode())
+    h.update(np.ascontiguousarray(array).data)
+    return h.hexdigest()
+
+class ResultCache:
+    """
+    Key-value store for JSON serializable results in a SQLite database.
+    SQLite handles locking, so a cache can be shared between worker processes.
+    """
+    def __init__(self, database_file_name):
+        self.database_file_name = os.path.abspath(database_file_name)
+        create_dir(os.path.dirname(self.database_file_name))
+        with contextlib.closing(self.connect()) as connection:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                   '(key TEXT PRIMARY KEY, value TEXT, created REAL)')
+    
+    def connect(self):
+        return sqlite3.connect(self.database_file_name, timeout=60)
+    
+    def get(self, key):
+        with contextlib.closing(self.connect()) as connection:
+            row = connection.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+    
+    def put(self, key, value):
+        value = json.dumps(value, default=lambda o: o.tolist())
+        with contextlib.closing(self.connect()) as connection:
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', 
+                                   (key, value, time.time()))
+
+def create_http_session(pool_size=10):
+    """
+    Returns a requests.Session that keeps up to pool_size connections per host alive,
+    to be shared between download threads.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size, 
+                                            pool_maxsize     = pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def download_file(url,
+                  output_file_name,
+                  session        = None,
+                  max_retries    = 5,
+                  backoff_factor = 1.0,
+                  timeout        = 60,
+                  chunk_size     = 2**20):
+    """
+    Streams url to output_file_name in chunks. 
+    
+    Data is written to output_file_name + '.part', which is renamed once complete. 
+    Connection errors, HTTP 429 and 5xx responses are retried after 
+    backoff_factor * 2**attempt seconds, resuming from the partial file with a Range request.
+    """
+    if isinstance(session, type(None)):
+        session = create_http_session()
+    part_file_name = output_file_name + '.part'
+    
+    for attempt in range(max_retries + 1):
+        if os.path.exists(part_file_name):
+            offset = os.path.getsize(part_file_name)
+        else:
+            offset = 0
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=' + str(offset) + '-'
+            
+        try:
+            response = session.get(url, headers=headers, stream=True, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            error = e
+        else:
+            with response:
+                if response.status_code == 416:
+                    # partial file does not match the remote file, start over
+                    os.remove(part_file_name)
+                    error = 'HTTP 416'
+                elif response.status_code == 429 or response.status_code >= 500:
+                    error = 'HTTP ' + str(response.status_code)
+                else:
+                    response.raise_for_status()
+                    if response.status_code == 206:
+                        mode = 'ab'
+                    else:
+                        # server ignored the Range header
+                        mode = 'wb'
+                        offset = 0
+                    try:
+                        with open(part_file_name, mode) as f:
+                            for chunk in response.iter_content(chunk_size=chunk_size):
+                                f.write(chunk)
+                    except requests.exceptions.RequestException as e:
+                        error = e
+                    else:
+                        expected_size = response.headers.get('Content-Length')
+                        if (not isinstance(expected_size, type(None)) and 
+                            'Content-Encoding' not in response.headers and
+                            os.path.getsize(part_file_name) != offset + int(expected_size)):
+                            error = 'incomplete download'
+                        else:
+                            os.replace(part_file_name, output_file_name)
+                            return output_file_name
+        
+        if attempt < max_retries:
+            wait = backoff_factor * 2**attempt
+            print('Retrying', url, 'in', wait, 's after:', error)
+            time.sleep(wait)
+            
+    raise RuntimeError('Unable to download ' + url + ' after ' + str(max_retries + 1) + 
+                       ' attempts: ' + str(error))
+
+def convert_to_tiled_tif(image_file_name, 
+                         output_file_name, 
+                         compress = 'LZW'):
+    """
+    Converts a single band 8-bit image on disk to a tiled, compressed GeoTIFF with 
+    gdal.Translate, which copies block by block without reading the full image into memory.
+    Other images are decoded to grayscale with cv2 and written with write_tiled_tif().
+    Raises ValueError if the file can not be read as an image.
+    """
+    ds = gdal.Open(image_file_name)
+    if ds is None:
+        raise ValueError('Unable to open ' + image_file_name + ' as an image')
+    
+    if ds.RasterCount == 1 and ds.GetRasterBand(1).DataType == gdal.GDT_Byte:
+        options = gdal.TranslateOptions(format = 'GTiff',
+                                        creationOptions = ['TILED=YES',
+                                                           'COMPRESS='+compress,
+                                                           'BIGTIFF=IF_SAFER'])
+        out = gdal.Translate(output_file_name, ds, options=options)
+        if out is None:
+            raise ValueError('Unable to convert ' + image_file_name)
+        out = None
+        ds = None
+    else:
+        ds = None
+        img_gray = cv2.imread(image_file_name, cv2.IMREAD_GRAYSCALE)
+        if img_gray is None:
+            raise ValueError('Unable to decode ' + image_file_name)
+        write_tiled_tif(img_gray, output_file_name, compress=compress)
+    
+    return output_file_name
+
+def link_file(source_file_name, destination_file_name):
+    """
+    Places source_file_name at destination_file_name as a hardlink, falling back to 
+    a symlink (e.g. across file systems) and a copy.
+    """
+    if os.path.lexists(destination_file_name):
+        if os.path.exists(destination_file_name) and os.path.samefile(source_file_name, 
+                                                                       destination_file_name):
+            return destination_file_name
+        os.remove(destination_file_name)
+    create_dir(os.path.dirname(os.path.abspath(destination_file_name)))
+    try:
+        os.link(source_file_name, destination_file_name)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source_file_name), destination_file_name)
+        except OSError:
+            shutil.copy2(source_file_name, destination_file_name)
+    return destination_file_name
+
+def stage_file(source_file_name, destination_file_name, strategy='copy'):
+    """
+    Places source_file_name at destination_file_name.
+    
+    strategy = 'copy'     # full copy with metadata
+               'hardlink' # shares the data, same file system only
+               'symlink'  # absolute symbolic link
+               'reflink'  # copy-on-write clone (e.g. btrfs, xfs), Linux only
+    Hardlinks and reflinks fall back to a copy where the file system does not support them.
+    """
+    if os.path.lexists(destination_file_name):
+        os.remove(destination_file_name)
+    create_dir(os.path.dirname(os.path.abspath(destination_file_name)))
+    
+    if strategy == 'hardlink':
+        try:
+            os.link(source_file_name, destination_file_name)
+            return destination_file_name
+        except OSError:
+            pass
+    elif strategy == 'symlink':
+        os.symlink(os.path.abspath(source_file_name), destination_file_name)
+        return destination_file_name
+    elif strategy == 'reflink':
+        try:
+            import fcntl
+            FICLONE = 0x40049409
+            with open(source_file_name, 'rb') as src, open(destination_file_name, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source_file_name, destination_file_name)
+            return destination_file_name
+        except (ImportError, OSError):
+            if os.path.exists(destination_file_name):
+                os.remove(destination_file_name)
+    elif strategy != 'copy':
+        raise ValueError('Unknown staging strategy: ' + str(strategy))
+    
+    shutil.copy2(source_file_name, destination_file_name)
+    return destination_file_name
+
+def write_image_manifest(image_file_names, output_file_name):
+    """
+    Writes absolute image paths, one per line, to a text file that can be passed 
+    to hsfm.metashape.images2las instead of an image directory.
+    """
+    create_dir(os.path.dirname(os.path.abspath(output_file_name)))
+    with open(output_file_name, 'w') as f:
+        for image_file_name in image_file_names:
+            f.write(os.path.abspath(image_file_name) + '\n')
+    return output_file_name
+
+def read_image_manifest(manifest_file_name):
+    with open(manifest_file_name) as f:
+        return [line.strip() for line in f if line.strip()]
+
+class ArchiveCache:
+    """
+    Content addressed cache for immutable archive images, shared between projects.
+    
+    Files are stored once under objects/ by sha256 checksum and indexed by archive 
+    identifier, e.g. a NAGAP PID or EarthExplorer entityId, with their size and last use. 
+    Projects link to the cached files, see link_file(). If max_size_gb is set, the least 
+    recently used files are evicted once the cache grows beyond it. Hardlinked project 
+    files are not affected by eviction.
+    
+    cache_directory = None # Defaults to the HSFM_CACHE_DIR environment variable, 
+                           # or ~/.cache/hsfm/archive.
+    """
+    def __init__(self, cache_directory=None, max_size_gb=None):
+        if isinstance(cache_directory, type(None)):
+            cache_directory = os.environ.get('HSFM_CACHE_DIR', 
+                                             os.path.join(os.path.expanduser('~'), '.cache', 'hsfm', 'archive'))
+        self.cache_directory    = create_dir(cache_directory)
+        self.objects_directory  = create_dir(os.path.join(self.cache_directory, 'objects'))
+        self.database_file_name = os.path.join(self.cache_directory, 'index.sqlite')
+        self.max_size_gb        = max_size_gb
+        with contextlib.closing(self.connect()) as connection:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                                   '(key TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, last_used REAL)')
+    
+    def connect(self):
+        return sqlite3.connect(self.database_file_name, timeout=60)
+    
+    def object_file_name(self, sha256):
+        return os.path.join(self.objects_directory, sha256[:2], sha256)
+    
+    def get(self, key, verify=False):
+        """
+        Returns the cached file for key, or None. The file size is always checked, 
+        verify = True also recomputes the checksum.
+        """
+        with contextlib.closing(self.connect()) as connection:
+            row = connection.execute('SELECT sha256, size FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        
+        sha256, size = row
+        file_name = self.object_file_name(sha256)
+        if (not os.path.exists(file_name) or 
+            os.path.getsize(file_name) != size or
+            (verify and hash_file(file_name, algorithm='sha256') != sha256)):
+            print('Removing invalid cache entry', key)
+            self.remove(key)
+            return None
+        
+        with contextlib.closing(self.connect()) as connection:
+            with connection:
+                connection.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+        return file_name
+    
+    def __contains__(self, key):
+        return not isinstance(self.get(key), type(None))
+    
+    def add(self, key, file_name, move=False):
+        """
+        Adds file_name to the cache under key and returns the cached file.
+        move = True # Move file_name into the cache instead of linking or copying it.
+        """
+        sha256 = hash_file(file_name, algorithm='sha256')
+        size   = os.path.getsize(file_name)
+        cached_file_name = self.object_file_name(sha256)
+        
+        if not os.path.exists(cached_file_name):
+            create_dir(os.path.dirname(cached_file_name))
+            # write under a temporary name, so that concurrent readers never see partial files
+            tmp = cached_file_name + '.' + str(os.getpid()) + '_' + str(threading.get_ident()) + '.tmp'
+            if move:
+                shutil.move(file_name, tmp)
+            else:
+                try:
+                    os.link(file_name, tmp)
+                except OSError:
+                    shutil.copy2(file_name, tmp)
+            os.replace(tmp, cached_file_name)
+        elif move:
+            os.remove(file_name)
+        
+        with contextlib.closing(self.connect()) as connection:
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', 
+                                   (key, sha256, size, time.time()))
+        self.evict(keep=key)
+        return cached_file_name
+    
+    def link(self, key, destination_file_name):
+        """
+        Links the cached file for key to destination_file_name.
+        """
+        file_name = self.get(key)
+        if isinstance(file_name, type(None)):
+            raise KeyError(key)
+        return link_file(file_name, destination_file_name)
+    
+    def fetch(self, key, destination_file_name, download, sha256=None):
+        """
+        Links the cached file for key to destination_file_name. If key is not cached, 
+        download(file_name) is called first to retrieve it into the cache.
+        
+        Each call downloads to its own temporary file, so concurrent fetches of the same 
+        key do not interfere, and the download is only added to the cache once complete.
+        The temporary file and any files download() writes next to it, e.g. partial or raw 
+        downloads, are removed afterwards, also if the download fails.
+        sha256 = None # Expected checksum, downloads that do not match are discarded.
+        """
+        if isinstance(self.get(key), type(None)):
+            downloads_directory = create_dir(os.path.join(self.cache_directory, 'downloads'))
+            fd, tmp = tempfile.mkstemp(dir    = downloads_directory, 
+                                       prefix = key.replace('/', '_').replace(':', '_') + '.')
+            os.close(fd)
+            try:
+                download(tmp)
+                if not isinstance(sha256, type(None)) and hash_file(tmp, algorithm='sha256') != sha256:
+                    raise ValueError('Checksum mismatch for downloaded ' + str(key))
+                self.add(key, tmp, move=True)
+            finally:
+                # e.g. tmp.part, or tmp.download and tmp.download.part from download_image_to_disk
+                for file_name in [tmp] + glob.glob(glob.escape(tmp) + '.*'):
+                    if os.path.exists(file_name):
+                        os.remove(file_name)
+        return self.link(key, destination_file_name)
+    
+    def remove(self, key):
+        with contextlib.closing(self.connect()) as connection:
+            with connection:
+                row = connection.execute('SELECT sha256 FROM entries WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return
+                connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                references = connection.execute('SELECT COUNT(*) FROM entries WHERE sha256 = ?', 
+                                                row).fetchone()[0]
+        file_name = self.object_file_name(row[0])
+        if references == 0 and os.path.exists(file_name):
+            os.remove(file_name)
+    
+    def size(self):
+        """
+        Total size of cached files in bytes.
+        """
+        with contextlib.closing(self.connect()) as connection:
+            rows = connection.execute('SELECT DISTINCT sha256, size FROM entries').fetchall()
+        return sum([i[1] for i in rows])
+    
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache is within max_size_gb.
+        keep = None # Key that is never evicted, e.g. the entry that was just added, 
+                    # even if it alone is larger than max_size_gb.
+        """
+        if isinstance(self.max_size_gb, type(None)):
+            return
+        max_size = self.max_size_gb * 1e9
+        total_size = self.size()
+        if total_size <= max_size:
+            return
+        
+        with contextlib.closing(self.connect()) as connection:
+            rows = connection.execute('SELECT key, sha256, size FROM entries ORDER BY last_used').fetchall()
+        for key, sha256, size in rows:
+            if total_size <= max_size:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            if not os.path.exists(self.object_file_name(sha256)):
+                total_size = total_size - size
+
+def get_archive_cache(cache=None):
+    """
+    Returns an ArchiveCache for cache, which can be an ArchiveCache, a cache directory or 
+    True for the default directory. Without cache, the HSFM_CACHE_DIR environment 
+    variable enables the cache. Returns None if no cache is used.
+    """
+    if isinstance(cache, ArchiveCache):
+        return cache
+    if cache is True:
+        return ArchiveCache()
+    if isinstance(cache, str):
+        return ArchiveCache(cache)
+    if cache is None and 'HSFM_CACHE_DIR' in os.environ:
+        return ArchiveCache()
+    return None
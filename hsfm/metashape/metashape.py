@@ -86,8 +86,10 @@ def images2las(project_name,
     metashape_metadata_df = pd.read_csv(images_metadata_file)
     image_file_names = list(metashape_metadata_df['image_file_name'].values)
     
-    # can pass directory or list of image files if spread accross directories
-    if isinstance(images_path, type('')):
+    # can pass directory, manifest text file or list of image files if spread accross directories
+    if isinstance(images_path, type('')) and images_path.endswith('.txt'):
+        image_file_paths = hsfm.io.read_image_manifest(images_path)
+    elif isinstance(images_path, type('')):
         image_file_paths = sorted(glob.glob(os.path.join(images_path,'*.tif')))
     elif isinstance(images_path, type([])):
         image_file_paths = images_path
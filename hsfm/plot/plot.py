@@ -41,7 +41,12 @@ def plot_principal_point_and_fiducial_locations(image_array,
                                                 fiducials,
                                                 principal_point,
                                                 image_base_name,
-                                                output_directory='qc/image_preprocessing/'):
+                                                output_directory='qc/image_preprocessing/',
+                                                image_scale=1):
+    """
+    image_scale = 10 # Factor image_array was downsampled by, fiducials and principal point 
+                     # are plotted at full resolution pixel coordinates.
+    """
                                                 
     left_fiducial = fiducials[0]
     top_fiducial = fiducials[1]
@@ -79,7 +84,11 @@ def plot_principal_point_and_fiducial_locations(image_array,
             color='k', lw=0.1)
     ax.legend()
     
-    plt.imshow(image_array, alpha=0.9, cmap='gray')
+    if image_scale == 1:
+        plt.imshow(image_array, alpha=0.9, cmap='gray')
+    else:
+        extent = (0, image_array.shape[1] * image_scale, image_array.shape[0] * image_scale, 0)
+        plt.imshow(image_array, alpha=0.9, cmap='gray', extent=extent)
     
     if output_directory == None:
         plt.show()
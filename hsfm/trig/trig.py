@@ -141,6 +141,41 @@ def calculate_corner(x,y,w,h,heading):
 
     return UL, UR, LR, LL
     
+def rotate_corners(x, y, half_width, half_height, heading):
+    """
+    Corners of rectangles centered on x (easting), y (northing), extending half_width 
+    along the heading (degrees clockwise from north) and half_height across it, 
+    for arrays of any of the inputs. 
+    Returns an (N, 4, 2) array of (x, y) ordered upper left, upper right, lower right, lower left.
+    """
+    x, y, w, h, heading = np.broadcast_arrays(*[np.atleast_1d(np.asarray(v, dtype=float)) 
+                                                for v in (x, y, half_width, half_height, heading)])
+    theta = np.radians(heading)
+    sin, cos = np.sin(theta), np.cos(theta)
+    
+    # along and across track offsets of UL, UR, LR, LL
+    along  = np.array([ 1,  1, -1, -1]) * w[:, None]
+    across = np.array([-1,  1,  1, -1]) * h[:, None]
+    
+    corners = np.empty(x.shape + (4, 2))
+    corners[..., 0] = x[:, None] + along * sin[:, None] + across * cos[:, None]
+    corners[..., 1] = y[:, None] + along * cos[:, None] - across * sin[:, None]
+    return corners
+    
+def calculate_corners(x, y, w, h, heading):
+    """
+    Array version of calculate_corner() for vectors of centers, half-widths, half-heights 
+    and headings, with x and y in the same order as there. 
+    Returns an (N, 4, 2) array of UL, UR, LR, LL, each as (lat, lon) like calculate_corner().
+    """
+    corners = rotate_corners(y, x, w, h, heading)
+    
+    # calculate_corner() returns UL and LR swapped for a heading of exactly 180
+    heading = np.broadcast_to(np.atleast_1d(np.asarray(heading, dtype=float)), corners.shape[:1])
+    south = heading == 180
+    corners[south] = corners[south][:, [2, 1, 0, 3]]
+    return corners
+    
 def check_angle(point1,point2,point3):
     vector21 = np.array(point2) - np.array(point1)
     vector31 = np.array(point3) - np.array(point1)
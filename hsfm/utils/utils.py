@@ -661,10 +661,7 @@ def create_fiducials(image_array,
                      
     hsfm.io.create_dir('tmp/')
     temp_out = os.path.join('tmp/', 'temporary_image.tif')
-    cv2.imwrite(temp_out,image_array)
-    temp_out_optimized = hsfm.utils.optimize_geotif(temp_out)
-    os.remove(temp_out)
-    os.rename(temp_out_optimized, temp_out)
+    hsfm.io.write_tiled_tif(image_array, temp_out)
     
     hv_image, subplot_width, subplot_height = hsfm.utils.hv_plot_raster(temp_out)
     
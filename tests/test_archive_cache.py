@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+# hsfm.io needs GDAL
+pytest.importorskip('osgeo')
+import hsfm.io
+
+
+def write_file(file_name, data):
+    with open(file_name, 'wb') as f:
+        f.write(data)
+    return file_name
+
+
+def read_file(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+
+def test_add_stores_identical_content_once(tmp_path):
+    cache = hsfm.io.ArchiveCache(str(tmp_path / 'cache'))
+    a = write_file(str(tmp_path / 'a.tif'), b'scan')
+    b = write_file(str(tmp_path / 'b.tif'), b'scan')
+
+    cached_a = cache.add('a', a)
+    cached_b = cache.add('b', b)
+
+    assert cached_a == cached_b
+    assert read_file(cached_a) == b'scan'
+    assert 'a' in cache and 'b' in cache
+    assert cache.size() == 4
+    # without move the original files stay in place
+    assert os.path.exists(a) and os.path.exists(b)
+
+
+def test_link_places_cached_file(tmp_path):
+    cache = hsfm.io.ArchiveCache(str(tmp_path / 'cache'))
+    cache.add('a', write_file(str(tmp_path / 'a.tif'), b'scan'))
+
+    destination = str(tmp_path / 'project' / 'raw_images' / 'a.tif')
+    assert cache.link('a', destination) == destination
+    assert read_file(destination) == b'scan'
+
+    with pytest.raises(KeyError):
+        cache.link('missing', str(tmp_path / 'missing.tif'))
+
+
+def test_fetch_downloads_only_once(tmp_path):
+    cache = hsfm.io.ArchiveCache(str(tmp_path / 'cache'))
+    calls = []
+
+    def download(file_name):
+        calls.append(file_name)
+        write_file(file_name, b'scan')
+
+    for project in ['project_1', 'project_2']:
+        destination = str(tmp_path / project / 'a.tif')
+        cache.fetch('a', destination, download)
+        assert read_file(destination) == b'scan'
+
+    assert len(calls) == 1
+    assert os.listdir(os.path.join(cache.cache_directory, 'downloads')) == []
+
+
+def test_failed_fetch_leaves_no_downloads(tmp_path):
+    cache = hsfm.io.ArchiveCache(str(tmp_path / 'cache'))
+
+    def download(file_name):
+        # leaves the files download_image_to_disk writes when the conversion fails
+        write_file(file_name + '.download', b'raw scan')
+        write_file(file_name + '.download.part', b'raw')
+        raise ValueError('Unable to read image')
+
+    with pytest.raises(ValueError):
+        cache.fetch('a', str(tmp_path / 'a.tif'), download)
+
+    assert os.listdir(os.path.join(cache.cache_directory, 'downloads')) == []
+    assert 'a' not in cache
+    assert not os.path.exists(str(tmp_path / 'a.tif'))
+
+
+def test_fetch_discards_checksum_mismatch(tmp_path):
+    cache = hsfm.io.ArchiveCache(str(tmp_path / 'cache'))
+
+    with pytest.raises(ValueError):
+        cache.fetch('a', str(tmp_path / 'a.tif'),
+                    lambda file_name: write_file(file_name, b'scan'),
+                    sha256 = '0' * 64)
+
+    assert os.listdir(os.path.join(cache.cache_directory, 'downloads')) == []
+    assert 'a' not in cache
+
+
+def test_evict_removes_least_recently_used(tmp_path):
+    cache = hsfm.io.ArchiveCache(str(tmp_path / 'cache'), max_size_gb=25e-9)
+    for key in ['a', 'b']:
+        cache.add(key, write_file(str(tmp_path / (key + '.tif')), key.encode() * 10))
+
+    # use a, so that b is the least recently used entry
+    assert 'a' in cache
+    cache.add('c', write_file(str(tmp_path / 'c.tif'), b'c' * 10))
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert cache.size() == 20
+
+
+def test_evict_keeps_entry_larger_than_cache(tmp_path):
+    cache = hsfm.io.ArchiveCache(str(tmp_path / 'cache'), max_size_gb=5e-9)
+    cache.add('a', write_file(str(tmp_path / 'a.tif'), b'a' * 4))
+
+    destination = str(tmp_path / 'b.tif')
+    cache.fetch('b', destination, lambda file_name: write_file(file_name, b'b' * 10))
+
+    assert read_file(destination) == b'b' * 10
+    assert 'a' not in cache
+    assert 'b' in cache
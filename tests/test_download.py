@@ -0,0 +1,89 @@
+import http.server
+import threading
+
+import pytest
+
+# hsfm.io needs GDAL
+pytest.importorskip('osgeo')
+import hsfm.io
+
+DATA = bytes(range(256)) * 1024
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Fails the first request with HTTP 503, drops the connection half way through 
+    the second and serves Range requests after that.
+    """
+    requests_seen = []
+    
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        self.requests_seen.append(range_header)
+        attempt = len(self.requests_seen)
+        
+        if attempt == 1:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        
+        if attempt == 2:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(DATA)))
+            self.end_headers()
+            self.wfile.write(DATA[:len(DATA)//2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        
+        offset = int(range_header.split('=')[1].rstrip('-')) if range_header else 0
+        body = DATA[offset:]
+        self.send_response(206 if range_header else 200)
+        self.send_header('Content-Length', str(len(body)))
+        if range_header:
+            self.send_header('Content-Range', 
+                             'bytes ' + str(offset) + '-' + str(len(DATA)-1) + '/' + str(len(DATA)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    FlakyHandler.requests_seen = []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:' + str(httpd.server_address[1]) + '/image.tif'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_file_retries_and_resumes_with_range(server, tmp_path):
+    output_file_name = str(tmp_path / 'image.tif')
+    
+    hsfm.io.download_file(server, 
+                          output_file_name, 
+                          max_retries    = 3, 
+                          backoff_factor = 0, 
+                          chunk_size     = 1024)
+    
+    with open(output_file_name, 'rb') as f:
+        assert f.read() == DATA
+    assert not (tmp_path / 'image.tif.part').exists()
+    
+    # 503, truncated response, then a Range request resuming from the partial file
+    assert FlakyHandler.requests_seen[:2] == [None, None]
+    assert FlakyHandler.requests_seen[-1] == 'bytes=' + str(len(DATA)//2) + '-'
+
+
+def test_download_file_gives_up_after_max_retries(server, tmp_path):
+    FlakyHandler.requests_seen = []
+    with pytest.raises(RuntimeError):
+        hsfm.io.download_file(server, 
+                              str(tmp_path / 'image.tif'), 
+                              max_retries    = 0, 
+                              backoff_factor = 0)
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+# hsfm.core needs GDAL, calculate_heading_from_metadata is in hsfm.batch, which needs hipp
+pytest.importorskip('osgeo')
+pytest.importorskip('hipp')
+import hsfm.batch
+import hsfm.core
+
+
+def metadata(points):
+    return pd.DataFrame({'fileName':  ['NAGAP_77V6_' + str(i).zfill(3) for i in range(len(points))],
+                         'Longitude': [i[0] for i in points],
+                         'Latitude':  [i[1] for i in points]})
+
+
+def east_zigzag_north():
+    # a line heading east, two images with sharp turns, and a line heading north
+    points = [(0.01 * i, 45.0) for i in range(5)]
+    points = points + [(0.045, 45.01), (0.05, 45.0)]
+    points = points + [(0.05, 45.0 + 0.01 * (i + 1)) for i in range(5)]
+    return metadata(points)
+
+
+def test_consecutive_single_image_segments_join_preceding_line():
+    flights = hsfm.core.determine_flight_lines(east_zigzag_north())
+
+    file_names = [list(i['fileName'].str[-3:]) for i in flights]
+    assert file_names == [['000', '001', '002', '003', '004', '005'],
+                          ['006', '007', '008', '009', '010', '011']]
+
+
+def test_single_image_segment_at_start_joins_following_line():
+    points = [(0.0, 44.95)] + [(0.01 * i, 45.0) for i in range(5)]
+    flights = hsfm.core.determine_flight_lines(metadata(points))
+
+    assert len(flights) == 1
+    assert len(flights[0]) == 6
+
+
+def test_flight_line_heading_columns_are_consistent():
+    flights = hsfm.core.determine_flight_lines(east_zigzag_north())
+
+    for flight in flights:
+        # the last image of a flight line carries the heading of the preceding image
+        assert flight['heading'].values[-1] == flight['heading'].values[-2]
+
+    df = pd.concat(flights).reset_index(drop=True)
+    np.testing.assert_array_equal(df['next_heading'].values[:-1], df['heading'].values[1:])
+    np.testing.assert_allclose(df['heading_diff'].values,
+                               abs(df['heading'].shift(-1) - df['heading']).fillna(0).values)
+
+
+def test_reverse_order_headings_stay_with_their_images():
+    df = metadata([(0.01 * i, 45.0) for i in range(5)])
+    df = hsfm.batch.calculate_heading_from_metadata(df, reverse_order=True)
+
+    assert list(df['fileName']) == sorted(df['fileName'])
+    # flown west, the first image by name is the last one flown and carries the heading forward
+    np.testing.assert_allclose(df['heading'].values, 270, atol=0.01)
@@ -0,0 +1,163 @@
+import itertools
+
+import geopandas as gpd
+import numpy as np
+import pytest
+
+# hsfm.core needs GDAL
+pytest.importorskip('osgeo')
+import hsfm.core
+
+THRESHOLD = 200000
+
+
+def synthetic_footprints(n=80, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(500000, 505000, n)
+    y = rng.uniform(5200000, 5205000, n)
+    gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs='epsg:32610')
+    gdf['radius']  = rng.uniform(200, 800, n)
+    gdf['polygon'] = gdf.geometry.buffer(gdf['radius'].values)
+    file_names = ['image_' + str(i).zfill(3) for i in range(n)]
+    return gdf, file_names
+
+
+def brute_force_overlaps(gdf, file_names, threshold):
+    # intersects every pair of footprint polygons, as determine_image_clusters used to
+    matches = []
+    areas   = []
+    for (a, pa), (b, pb) in itertools.combinations(zip(file_names, gdf['polygon'].values), 2):
+        area = pa.intersection(pb).area
+        if area > threshold:
+            matches.append((a, b))
+            areas.append(area)
+    return matches, areas
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_find_overlapping_footprints_matches_brute_force(seed):
+    gdf, file_names = synthetic_footprints(seed=seed)
+    
+    matches, areas = hsfm.core.find_overlapping_footprints(gdf, file_names, THRESHOLD)
+    expected_matches, expected_areas = brute_force_overlaps(gdf, file_names, THRESHOLD)
+    
+    assert matches == expected_matches
+    # circle areas in closed form differ from the buffered polygons by the polygon sagitta
+    np.testing.assert_allclose(areas, expected_areas, rtol=0.01)
+
+
+def test_find_overlapping_footprints_subset_matches_full_recomputation():
+    gdf, file_names = synthetic_footprints(seed=3)
+    matches, areas = hsfm.core.find_overlapping_footprints(gdf, file_names, THRESHOLD)
+    
+    # grow the footprints of some images, as determine_image_clusters does for unmatched images
+    grown = np.arange(0, len(gdf), 7)
+    gdf.loc[gdf.index[grown], 'radius']  = gdf['radius'].values[grown] + 500
+    gdf['polygon'] = gdf.geometry.buffer(gdf['radius'].values)
+    
+    new_matches, _ = hsfm.core.find_overlapping_footprints(gdf, file_names, THRESHOLD, subset=grown)
+    expected_matches, _ = brute_force_overlaps(gdf, file_names, THRESHOLD)
+    
+    untouched = [m for m in matches if not set(m) & set(np.array(file_names)[grown])]
+    positions = {file_name: i for i, file_name in enumerate(file_names)}
+    combined  = sorted(set(untouched + new_matches), key=lambda m: (positions[m[0]], positions[m[1]]))
+    assert combined == expected_matches
+
+
+def synthetic_rectangles(n=60, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(500000, 506000, n)
+    y = rng.uniform(5200000, 5206000, n)
+    heading = rng.uniform(0, 360, n)
+    # 152 mm focal length, 20 micron pixels and 9000 px square scans at 1000 to 2000 m above ground
+    altitude = rng.uniform(1000, 2000, n)
+    gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs='epsg:32610')
+    gdf['polygon'] = hsfm.core.compute_footprints(x, y, altitude, 152, 0.02, 9000, heading=heading)
+    GSD = hsfm.core.compute_GSD(altitude, 0.02, 152, verbose=False)
+    gdf['radius'] = GSD * 9000 / np.sqrt(2)
+    file_names = ['image_' + str(i).zfill(3) for i in range(n)]
+    return gdf, file_names
+
+
+def test_compute_footprints_rotates_rectangles_to_heading():
+    x, y = 500000.0, 5200000.0
+    GSD = hsfm.core.compute_GSD(1500.0, 0.02, 152, verbose=False)
+    north, east = hsfm.core.compute_footprints([x, x], [y, y], 1500, 152, 0.02, 9000, 6000, heading=[0, 90])
+    
+    for polygon in [north, east]:
+        np.testing.assert_allclose(polygon.area, GSD**2 * 9000 * 6000)
+        np.testing.assert_allclose([polygon.centroid.x, polygon.centroid.y], [x, y])
+    # the width lies along the heading
+    min_x, min_y, max_x, max_y = north.bounds
+    np.testing.assert_allclose([max_x - min_x, max_y - min_y], [GSD * 6000, GSD * 9000])
+    min_x, min_y, max_x, max_y = east.bounds
+    np.testing.assert_allclose([max_x - min_x, max_y - min_y], [GSD * 9000, GSD * 6000])
+
+
+def test_compute_square_footprint_uses_heading_column_and_keeps_gdf():
+    pytest.importorskip('utm')
+    df = gpd.GeoDataFrame({'Longitude': [-121.83, -121.82],
+                           'Latitude':  [48.73, 48.73],
+                           'heading':   [0.0, 45.0]})
+    columns = list(df.columns)
+    
+    footprints = hsfm.core.compute_square_footprint(df, 9000, 0.02, 152, 1500)
+    
+    assert list(df.columns) == columns
+    min_x, min_y, max_x, max_y = footprints[0].bounds
+    GSD = hsfm.core.compute_GSD(1500, 0.02, 152, verbose=False)
+    np.testing.assert_allclose(max_x - min_x, GSD * 9000)
+    # rotated by 45 degrees, the bounds grow by sqrt(2)
+    min_x, min_y, max_x, max_y = footprints[1].bounds
+    np.testing.assert_allclose(max_x - min_x, GSD * 9000 * np.sqrt(2))
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_find_overlapping_rectangles_matches_brute_force(seed):
+    gdf, file_names = synthetic_rectangles(seed=seed)
+    
+    matches, areas = hsfm.core.find_overlapping_footprints(gdf, file_names, THRESHOLD, circles=False)
+    expected_matches, expected_areas = brute_force_overlaps(gdf, file_names, THRESHOLD)
+    
+    assert len(matches) > 0
+    assert matches == expected_matches
+    np.testing.assert_allclose(areas, expected_areas)
+    
+    # growing some footprints only re-tests their pairs, as in determine_image_clusters
+    grown = np.arange(0, len(gdf), 5)
+    gdf.loc[gdf.index[grown], 'polygon'] = gdf.geometry.values[grown].buffer(gdf['radius'].values[grown] + 500)
+    gdf.loc[gdf.index[grown], 'radius']  = gdf['radius'].values[grown] + 500
+    new_matches, _ = hsfm.core.find_overlapping_footprints(gdf, file_names, THRESHOLD, 
+                                                           subset  = grown, 
+                                                           circles = False)
+    expected_matches, _ = brute_force_overlaps(gdf, file_names, THRESHOLD)
+    grown_matches = [m for m in expected_matches if set(m) & set(np.array(file_names)[grown])]
+    assert new_matches == grown_matches
+
+
+def write_gcp_file(file_name, lon, lat):
+    # corners of a square footprint in the columns get_gcp_polygon reads
+    corners = [(lat, lon), (lat, lon + 0.01), (lat + 0.01, lon + 0.01), (lat + 0.01, lon)]
+    with open(file_name, 'w') as f:
+        f.write(''.join(str(i) + ' ' + str(c[0]) + ' ' + str(c[1]) + '\n' for i, c in enumerate(corners)))
+
+
+def test_create_overlap_list_skips_cameras_without_image(tmp_path, capsys):
+    gcp_directory   = tmp_path / 'gcp'
+    image_directory = tmp_path / 'images'
+    gcp_directory.mkdir()
+    image_directory.mkdir()
+    for i, name in enumerate(['image_000', 'image_001', 'image_002']):
+        write_gcp_file(str(gcp_directory / (name + '.gcp')), -121.8 + 0.005 * i, 48.7)
+    for name in ['image_000', 'image_001']:
+        (image_directory / (name + '.tif')).write_text('')
+
+    filename_out = hsfm.core.create_overlap_list(str(gcp_directory), str(image_directory), str(tmp_path))
+
+    with open(filename_out) as f:
+        pairs = [i.split() for i in f.read().splitlines()]
+    assert [[i.split('/')[-1] for i in pair] for pair in pairs] == [['image_000.tif', 'image_001.tif']]
+    # one warning for all pairs with image_002
+    warnings = [i for i in capsys.readouterr().out.splitlines() if 'WARNING' in i]
+    assert len(warnings) == 1
+    assert 'image_002' in warnings[0]
@@ -0,0 +1,111 @@
+import os
+
+import pandas as pd
+import pytest
+
+# hsfm.batch needs GDAL and hipp
+pytest.importorskip('osgeo')
+pytest.importorskip('hipp')
+import hsfm.batch
+import hsfm.core
+
+CRASH = 'image_003'
+
+
+def fake_worker(image_file_name, template_directory, output_directory, **kwargs):
+    # stands in for preprocess_image_worker in the spawned worker processes
+    file_name = os.path.splitext(os.path.split(image_file_name)[-1])[0]
+    if file_name == os.environ.get('HSFM_TEST_CRASH'):
+        # kill the worker process, which breaks the pool
+        os._exit(1)
+    with open(os.path.join(output_directory, file_name + '.tif'), 'w') as f:
+        f.write('cropped')
+    return {'image_file_name': image_file_name,
+            'file_name':       file_name,
+            'status':          'detected',
+            'elapsed_time_s':  0.0}
+
+
+def run_pipeline(tmp_path, monkeypatch, n=8, max_in_flight=2, keep_raw=False):
+    raw_image_directory = str(tmp_path / 'raw_images')
+    output_directory    = str(tmp_path / 'cropped_images')
+    df = pd.DataFrame({'pid_tiff': ['pid_' + str(i) for i in range(n)],
+                       'fileName': ['image_' + str(i).zfill(3) for i in range(n)]})
+
+    on_disk = []
+    def fake_download(pid, output_file_name, **kwargs):
+        # raw images that are downloaded or waiting for preprocessing
+        on_disk.append(len([i for i in os.listdir(raw_image_directory) if i.endswith('.tif')]))
+        with open(output_file_name, 'w') as f:
+            f.write(pid)
+        return output_file_name
+
+    monkeypatch.setattr(hsfm.core, 'download_image_to_disk', fake_download)
+    monkeypatch.setattr(hsfm.batch.batch, 'preprocess_image_worker', fake_worker)
+
+    manifest = hsfm.batch.download_and_preprocess_images(df,
+                                                         str(tmp_path),
+                                                         raw_image_directory,
+                                                         output_directory,
+                                                         max_download_workers = 2,
+                                                         max_workers          = 1,
+                                                         max_in_flight        = max_in_flight,
+                                                         keep_raw             = keep_raw)
+    return manifest, on_disk, raw_image_directory, output_directory
+
+
+def test_pipeline_bounds_raw_images_on_disk(tmp_path, monkeypatch):
+    manifest, on_disk, raw_image_directory, output_directory = run_pipeline(tmp_path, 
+                                                                            monkeypatch,
+                                                                            max_in_flight = 3)
+
+    assert len(manifest) == 8
+    assert set(manifest['status']) == {'detected'}
+    # at most two other images are in flight when a download starts
+    assert max(on_disk) <= 2
+    assert len(os.listdir(output_directory)) == 8 + 1 # cropped images and the manifest
+    # keep_raw = False deletes raw images once they are cropped
+    assert os.listdir(raw_image_directory) == []
+
+
+def test_pipeline_keeps_failed_raw_images(tmp_path, monkeypatch):
+    monkeypatch.setenv('HSFM_TEST_CRASH', CRASH)
+    manifest, on_disk, raw_image_directory, output_directory = run_pipeline(tmp_path, 
+                                                                            monkeypatch,
+                                                                            max_in_flight = 1)
+
+    detected = manifest[manifest['status'] == 'detected']
+    assert len(detected) == 7
+    assert not any([os.path.exists(i) for i in detected['image_file_name']])
+
+    # the image that crashed its worker failed and keeps its raw file
+    failed = manifest[manifest['status'] == 'failed']
+    assert list(failed['file_name']) == [CRASH]
+    assert os.path.exists(failed['image_file_name'].values[0])
+    assert 'preprocessing' in failed['error'].values[0]
+
+
+def test_pipeline_replaces_broken_pool(tmp_path, monkeypatch):
+    monkeypatch.setenv('HSFM_TEST_CRASH', CRASH)
+    manifest, on_disk, raw_image_directory, output_directory = run_pipeline(tmp_path,
+                                                                            monkeypatch,
+                                                                            max_in_flight = 1,
+                                                                            keep_raw      = True)
+
+    # images after the crash are preprocessed by a new pool
+    statuses = dict(zip(manifest['file_name'], manifest['status']))
+    assert statuses.pop(CRASH) == 'failed'
+    assert set(statuses.values()) == {'detected'}
+    assert os.path.exists(os.path.join(raw_image_directory, CRASH + '.tif'))
+    assert os.path.exists(os.path.join(output_directory, 'preprocessing_manifest.csv'))
+
+
+@pytest.mark.parametrize('argument', ['threshold_px', 'missing_proxy', 'image_square_dim'])
+def test_fiducials_preprocessing_rejects_proxy_arguments(tmp_path, argument):
+    with pytest.raises(ValueError, match=argument):
+        hsfm.batch.NAGAP_pre_process_set(pd.DataFrame(),
+                                         [],
+                                         [],
+                                         str(tmp_path),
+                                         preprocessing = 'fiducials',
+                                         **{argument: 50})
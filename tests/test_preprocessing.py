@@ -0,0 +1,110 @@
+import os
+import collections
+
+import pytest
+
+# hsfm.batch needs GDAL and hipp
+pytest.importorskip('osgeo')
+pytest.importorskip('hipp')
+import hsfm.batch
+
+CRASH  = 'image_002'
+MANUAL = 'image_004'
+
+
+def fake_worker(image_file_name, template_directory, output_directory, **kwargs):
+    # stands in for preprocess_image_worker in the worker processes
+    file_name = os.path.splitext(os.path.split(image_file_name)[-1])[0]
+    if file_name == os.environ.get('HSFM_TEST_CRASH'):
+        # kill the worker process, which breaks the pool
+        os._exit(1)
+    if file_name == MANUAL:
+        if kwargs.get('manually_pick_fiducials'):
+            status = 'picked_manually'
+        else:
+            status = 'needs_manual_pick'
+    else:
+        status = 'detected'
+    row = {'image_file_name': image_file_name,
+           'file_name':       file_name,
+           'status':          status,
+           'elapsed_time_s':  0.0}
+    for position in ['left', 'top', 'right', 'bottom']:
+        row[position+'_fiducial_x']     = 0
+        row[position+'_fiducial_y']     = 0
+        # too low to learn roll priors from
+        row[position+'_fiducial_score'] = 0.0
+    return row
+
+
+def run_preprocessing(tmp_path, monkeypatch, n=8, **kwargs):
+    image_directory  = str(tmp_path / 'raw_images')
+    output_directory = str(tmp_path / 'cropped_images')
+    os.makedirs(image_directory)
+    for i in range(n):
+        open(os.path.join(image_directory, 'image_' + str(i).zfill(3) + '.tif'), 'w').close()
+
+    monkeypatch.setattr(hsfm.batch.batch, 'preprocess_image_worker', fake_worker)
+    df = hsfm.batch.preprocess_images_parallel(image_directory,
+                                               str(tmp_path),
+                                               output_directory = output_directory,
+                                               max_workers      = 1,
+                                               **kwargs)
+    return df, os.path.join(output_directory, 'preprocessing_manifest.csv')
+
+
+def test_preprocessing_records_crashed_workers_in_manifest(tmp_path, monkeypatch):
+    monkeypatch.setenv('HSFM_TEST_CRASH', CRASH)
+    df, manifest_file_name = run_preprocessing(tmp_path, monkeypatch)
+
+    # every image has a row, also those pending in the broken pool
+    assert len(df) == 8
+    assert df.loc[df['file_name'] == CRASH, 'status'].values[0] == 'failed'
+    assert 'preprocessing' in df.loc[df['file_name'] == CRASH, 'error'].values[0]
+    manifest = hsfm.batch.read_preprocessing_manifest(manifest_file_name)
+    assert list(manifest['status']) == list(df['status'])
+
+
+def test_preprocessing_replaces_broken_pool_between_batches(tmp_path, monkeypatch):
+    monkeypatch.setenv('HSFM_TEST_CRASH', CRASH)
+    # roll_priors runs the images in batches of n_prior_images, which never yield priors here
+    df, manifest_file_name = run_preprocessing(tmp_path,
+                                               monkeypatch,
+                                               roll_priors    = True,
+                                               n_prior_images = 3)
+
+    statuses = dict(zip(df['file_name'], df['status']))
+    # the first batch contains the crash, the following batches run in a new pool
+    assert statuses.pop(CRASH) == 'failed'
+    assert statuses.pop(MANUAL) == 'needs_manual_pick'
+    assert set(statuses.values()) == {'detected'}
+
+
+def test_manual_pick_queue(tmp_path, monkeypatch):
+    df, manifest_file_name = run_preprocessing(tmp_path, monkeypatch)
+
+    counts = collections.Counter(df['status'])
+    assert counts == {'detected': 7, 'needs_manual_pick': 1}
+
+    df = hsfm.batch.pick_fiducials_from_manifest(manifest_file_name, str(tmp_path))
+    assert df.loc[df['file_name'] == MANUAL, 'status'].values[0] == 'picked_manually'
+    manifest = hsfm.batch.read_preprocessing_manifest(manifest_file_name)
+    assert set(manifest['status']) == {'detected', 'picked_manually'}
+
+
+def test_determine_max_workers_is_limited_by_memory(monkeypatch):
+    VirtualMemory = collections.namedtuple('VirtualMemory', ['available'])
+    monkeypatch.setattr(hsfm.batch.batch.psutil, 'virtual_memory', lambda: VirtualMemory(10e9))
+
+    assert hsfm.batch.determine_max_workers(4) == min(2, hsfm.batch.determine_max_workers(0.001))
+    # always at least one worker
+    assert hsfm.batch.determine_max_workers(100) == 1
+
+
+def test_estimate_preprocessing_memory_gb_grows_with_crop_and_threads():
+    small = hsfm.batch.estimate_preprocessing_memory_gb(5000, matching_threads=1)
+    large = hsfm.batch.estimate_preprocessing_memory_gb(11250, matching_threads=1)
+    assert 0 < small < large
+    assert hsfm.batch.estimate_preprocessing_memory_gb(11250, matching_threads=4) > large
+    # five uint8 copies of the crop alone
+    assert large > 5 * 11250**2 / 1e9
@@ -0,0 +1,85 @@
+import cv2
+import numpy as np
+import pytest
+
+# hsfm.core needs GDAL
+pytest.importorskip('osgeo')
+import hsfm.core
+
+
+def synthetic_fiducial(size=61):
+    template = np.full((size, size), 30, dtype=np.uint8)
+    center = size // 2
+    cv2.circle(template, (center, center), size // 3, 220, 3)
+    template[center-2:center+3, :] = 220
+    template[:, center-2:center+3] = 220
+    return template
+
+
+def synthetic_slice(template, row, col, shape=(900, 700), seed=0):
+    rng = np.random.default_rng(seed)
+    image_slice = rng.normal(60, 15, size=shape).clip(0, 255).astype(np.uint8)
+    h, w = template.shape
+    image_slice[row:row+h, col:col+w] = template
+    return image_slice
+
+
+@pytest.mark.parametrize('position', ['left', 'top', 'right', 'bottom'])
+@pytest.mark.parametrize('row, col', [(120, 85), (431, 307), (777, 590)])
+def test_pyramid_fiducial_within_one_pixel_of_full_search(position, row, col):
+    template = synthetic_fiducial()
+    window = [1000, 1900, 2000, 2700]
+    padded_slice = hsfm.core.pad_image(synthetic_slice(template, row, col))
+    
+    baseline = hsfm.core.get_fiducial(padded_slice, template, window, position=position)
+    for pyramid_scale in [2, 4]:
+        x, y = hsfm.core.get_fiducial(padded_slice, 
+                                      template, 
+                                      window, 
+                                      position      = position, 
+                                      pyramid_scale = pyramid_scale)
+        assert abs(x - baseline[0]) <= 1
+        assert abs(y - baseline[1]) <= 1
+
+
+def test_pyramid_fiducial_in_noisified_slice_matches_full_search():
+    template = synthetic_fiducial()
+    window = [0, 900, 0, 700]
+    padded_slice = hsfm.core.pad_image(synthetic_slice(template, 300, 200))
+    padded_slice = hsfm.core.noisify_template(padded_slice, rng=0)
+    
+    baseline = hsfm.core.get_fiducial(padded_slice, template, window, position='left')
+    x, y = hsfm.core.get_fiducial(padded_slice, template, window, position='left', pyramid_scale=4)
+    assert abs(x - baseline[0]) <= 1
+    assert abs(y - baseline[1]) <= 1
+
+
+def test_noisify_template_into_buffers_matches_allocated_noise():
+    image = np.random.default_rng(1).integers(0, 256, (300, 200), dtype=np.uint8)
+    expected = hsfm.core.noisify_template(image.copy(), rng=7)
+    
+    mask  = np.empty(image.shape, dtype=bool)
+    noise = np.empty(image.size + 10, dtype=np.uint8)
+    noisified = hsfm.core.noisify_template(image.copy(), rng=7, mask=mask, noise=noise, chunk_size=64)
+    np.testing.assert_array_equal(noisified, expected)
+    np.testing.assert_array_equal(mask, image > 50)
+
+
+def test_get_fiducial_rejects_invalid_position():
+    template = synthetic_fiducial()
+    padded_slice = hsfm.core.pad_image(synthetic_slice(template, 300, 200))
+    with pytest.raises(ValueError):
+        hsfm.core.get_fiducial(padded_slice, template, [0, 900, 0, 700], position=None)
+
+
+def test_fiducial_detection_options_fill_defaults():
+    options = hsfm.core.fiducial_detection_options({'n_seeds': 3}, pyramid_scale=4)
+    assert options['n_seeds'] == 3
+    assert options['pyramid_scale'] == 4
+    assert options['retry_engine'] == 'concurrent'
+    assert options['prior_windows'] is None
+    # keyword arguments take precedence over the dict
+    assert hsfm.core.fiducial_detection_options({'seed': 1}, seed=2)['seed'] == 2
+
+    with pytest.raises(ValueError, match='n_seed'):
+        hsfm.core.fiducial_detection_options({'n_seed': 3})
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+
+# hsfm.core needs GDAL
+pytest.importorskip('osgeo')
+import hsfm.core
+
+COLUMNS = ['image_file_name', 'lon', 'lat', 'alt', 'lon_acc', 'lat_acc', 'alt_acc',
+           'yaw', 'pitch', 'roll', 'yaw_acc', 'pitch_acc', 'roll_acc']
+
+
+def write_fixture(tmp_path):
+    # camera positions near Mount Baker and a pc_align transform with a small rotation and shift
+    df = pd.DataFrame({'image_file_name': ['NAGAP_77V6_' + str(i).zfill(3) + '.tif' for i in range(5)],
+                       'lon': [-121.846, -121.84, -121.835, -121.83, -121.823],
+                       'lat': [48.76, 48.75, 48.74, 48.72, 48.70],
+                       'alt': [3500.0, 3510.5, 3495.2, 3502.8, 3499.9]})
+    for column in COLUMNS[4:]:
+        df[column] = 1.0
+    df['lon_acc'] = 10.0
+    df = df[COLUMNS]
+    metadata_file = str(tmp_path / 'metashape_metadata.csv')
+    df.to_csv(metadata_file, index=False)
+
+    angle = 2e-5
+    transform = np.array([[np.cos(angle), -np.sin(angle), 0,  3.25],
+                          [np.sin(angle),  np.cos(angle), 0, -2.5],
+                          [0,              0,             1,  1.75],
+                          [0,              0,             0,  1]])
+    transform_file = str(tmp_path / 'pc_align-transform.txt')
+    np.savetxt(transform_file, transform, fmt='%.17g')
+    return metadata_file, transform_file, transform
+
+
+def per_row_metadata_transform(metadata_file, pc_align_transform_file):
+    # the previous implementation: GeoDataFrame round trips and the transform applied row by row
+    df = pd.read_csv(metadata_file)
+    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['lon'], df['lat'], df['alt']), crs='epsg:4326')
+    gdf = gdf.to_crs('epsg:4978')
+
+    transform = pd.read_csv(pc_align_transform_file, header=None, delimiter=r"\s+")
+    C_translation = list(transform.drop(3)[3].values)
+    R_transform = transform.drop(3).drop([3], axis=1).values.tolist()
+
+    xyz = []
+    for point in gdf.geometry.values:
+        C = [point.x, point.y, point.z]
+        xyz.append([R_transform[k][0]*C[0] + R_transform[k][1]*C[1] + R_transform[k][2]*C[2] + C_translation[k]
+                    for k in range(3)])
+    xyz = np.array(xyz)
+
+    transformed = gpd.GeoSeries(gpd.points_from_xy(xyz[:, 0], xyz[:, 1], xyz[:, 2]), crs='epsg:4978')
+    transformed = transformed.to_crs('epsg:4326')
+    df['lon'] = transformed.x.values
+    df['lat'] = transformed.y.values
+    df['alt'] = transformed.z.values
+    return df[COLUMNS].sort_values(by=['image_file_name'])
+
+
+def test_metadata_transform_matches_per_row_transform(tmp_path):
+    metadata_file, transform_file, transform = write_fixture(tmp_path)
+
+    expected = per_row_metadata_transform(metadata_file, transform_file)
+    output_file_name = str(tmp_path / 'aligned_metadata.csv')
+    transformed = hsfm.core.metadata_transform(metadata_file, transform_file, output_file_name=output_file_name)
+
+    assert list(transformed.columns) == COLUMNS
+    assert list(transformed['image_file_name']) == list(expected['image_file_name'])
+    np.testing.assert_allclose(transformed['lon'].values, expected['lon'].values, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(transformed['lat'].values, expected['lat'].values, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(transformed['alt'].values, expected['alt'].values, rtol=0, atol=1e-4)
+    np.testing.assert_array_equal(transformed['lon_acc'].values, expected['lon_acc'].values)
+    # the transform moves the cameras by a few meters
+    original = pd.read_csv(metadata_file)
+    assert np.abs(transformed['alt'].values - original['alt'].values).max() > 0.1
+    assert len(pd.read_csv(output_file_name)) == len(original)
+
+
+def test_position_transform_wrappers_match_matrix(tmp_path):
+    metadata_file, transform_file, transform = write_fixture(tmp_path)
+
+    C_translation, R_transform = hsfm.core.extract_transform(transform_file)
+    np.testing.assert_allclose(C_translation, transform[:3, 3])
+    np.testing.assert_allclose(R_transform, transform[:3, :3])
+
+    C = [-2318000.0, -3740000.0, 4780000.0]
+    np.testing.assert_allclose(hsfm.core.apply_position_transform(C, C_translation, R_transform),
+                               hsfm.core.apply_transform([C], hsfm.core.read_transform(transform_file))[0])
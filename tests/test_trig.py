@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import hsfm.trig
+
+HEADINGS = [0, 1, 30, 45, 89.5, 90, 91, 135, 170, 179.9, 180, 180.1, 
+            200, 225, 260, 269, 270, 271, 300, 315, 359, 360]
+
+
+@pytest.mark.parametrize('heading', HEADINGS)
+def test_calculate_corners_matches_calculate_corner(heading):
+    x, y, w, h = 5213450.0, 587320.0, 1450.0, 1210.0
+    
+    expected = np.array(hsfm.trig.calculate_corner(x, y, w, h, heading), dtype=float)
+    corners  = hsfm.trig.calculate_corners(x, y, w, h, heading)
+    
+    assert corners.shape == (1, 4, 2)
+    np.testing.assert_allclose(corners[0], expected, rtol=0, atol=1e-9)
+
+
+def test_calculate_corners_vectorized_over_headings():
+    n = len(HEADINGS)
+    rng = np.random.default_rng(0)
+    x = rng.uniform(5200000, 5300000, n)
+    y = rng.uniform(500000, 600000, n)
+    w = rng.uniform(500, 2000, n)
+    h = rng.uniform(500, 2000, n)
+    
+    corners  = hsfm.trig.calculate_corners(x, y, w, h, HEADINGS)
+    expected = np.array([hsfm.trig.calculate_corner(*args) for args in zip(x, y, w, h, HEADINGS)], 
+                        dtype=float)
+    
+    assert corners.shape == (n, 4, 2)
+    np.testing.assert_allclose(corners, expected, rtol=0, atol=1e-9)